@@ -1,15 +1,21 @@
-import os, glob, hashlib, threading, requests
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+import os, glob, json, time, asyncio, contextlib
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from modules.parser import extract_text_and_images
-from modules.embedder import embed_texts, model
-from modules.vector_store import VectorStore
+from modules.embedder import embed_texts, embedding_dim
+from modules.catalog import Catalog, CollectionError, DEFAULT_COLLECTION
+from modules.vector_store import LANG_MODES
+from modules.jobs import JobManager
+from modules.cache import QueryCache, normalize_question, embedding_key
+from modules.context import assemble, count_tokens, CONTEXT_CANDIDATES, CONTEXT_MAX_CHUNKS
+from modules import metrics, serving, images as image_store
+from llm.ollama_client import (
+    build_prompt, generate, stream_generate, close_async_client, LLMLimiter, LLMBusy, Coalescer,
+)
 from modules.utils import detect_language
-from typing import Optional
+from typing import Optional, List
 from fastapi.middleware.cors import CORSMiddleware
-from sentence_transformers import SentenceTransformer
-from fastapi.staticfiles import StaticFiles
 
 app = FastAPI(title="Document Chatbot")
 
@@ -22,15 +28,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.mount("/images", StaticFiles(directory="storage/images"), name="images")
-
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
 DOCS_DIR = ""  # Se define dinámicamente por el usuario
 
-model = SentenceTransformer("paraphrase-MiniLM-L6-v2")
-print("Dimensión de embeddings:", model.get_sentence_embedding_dimension())
-
-vs = VectorStore(dim=model.get_sentence_embedding_dimension())
+# Colecciones con nombre (storage/collections/<nombre>); la de por defecto es el storage/ de
+# siempre y queda cargada todo el tiempo
+catalog = Catalog(dim=embedding_dim(), read_only=serving.READ_ONLY)
+vs = catalog.get(DEFAULT_COLLECTION)
+qcache = QueryCache(catalog)
+llm_limiter = LLMLimiter()
+coalescer = Coalescer()
 
 # Cambia aquí: Si hay conocimiento cargado, pon done=True
 processing_status = {
@@ -40,155 +46,604 @@ processing_status = {
     "message": "Ready" if vs.has_knowledge() else "",
 }
 
+# Único escritor del índice: los jobs de /analyze se ejecutan en orden y se reanudan al reiniciar.
+# Los workers de solo lectura (SERVE_ROLE=reader) no ingieren: reenvían las escrituras al escritor
+# y leen el estado que este publica.
+jobs = None
+shared_status = None
+if serving.READ_ONLY:
+    shared_status = serving.StatusView()
+else:
+    jobs = JobManager(catalog, processing_status, publish=serving.SERVE_ROLE == "writer")
+    jobs.start()
+    if serving.SERVE_ROLE == "writer":
+        serving.publish_status(processing_status)
+
+def current_status():
+    return shared_status.get() if serving.READ_ONLY else processing_status
+
+def to_writer(method, path, params=None, body=None):
+    if not serving.WRITER_URL:
+        raise HTTPException(status_code=503, detail="Read-only worker: set SERVE_WRITER_URL to forward writes.")
+    try:
+        r = serving.forward(method, path, params=params, body=body)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Writer unavailable: {e}")
+    if r.status_code >= 400:
+        raise HTTPException(status_code=r.status_code, detail=r.json().get("detail"))
+    return r.json()
+
+# Valores que se leen al momento de exponer /metrics
+metrics.register("queue_depth", "gauge", lambda: llm_limiter.waiting, queue="llm_waiting")
+metrics.register("llm_running", "gauge", lambda: llm_limiter.running, "Generaciones en curso hacia Ollama")
+metrics.register("llm_rejected_total", "counter", lambda: llm_limiter.rejected, "Preguntas rechazadas con 429/503")
+metrics.register("coalesced_total", "counter", lambda: coalescer.coalesced, "Preguntas que compartieron una generación en vuelo")
+metrics.register("index_vectors", "gauge", lambda: vs.ntotal, "Vectores en el índice FAISS")
+metrics.register("collections_memory_bytes", "gauge", catalog.memory_bytes, "Memoria estimada de los índices cargados")
+metrics.register("collections_evicted_total", "counter", lambda: catalog.evictions, "Colecciones descargadas por el tope de memoria")
+metrics.register("ingest_progress", "gauge", lambda: current_status()["progress"], "Progreso de la ingesta (%)")
+for _name in ("embeddings", "results", "answers"):
+    metrics.register("cache_hits_total", "counter", lambda n=_name: getattr(qcache, n).hits, "Aciertos de caché", cache=_name)
+    metrics.register("cache_misses_total", "counter", lambda n=_name: getattr(qcache, n).misses, "Fallos de caché", cache=_name)
+
 class AnalyzeRequest(BaseModel):
     path: str
+    collection: Optional[str] = None
+    workers: Optional[int] = None
+    batch_size: Optional[int] = None
+    chunk_tokens: Optional[int] = None
+    chunk_overlap: Optional[int] = None
 
 @app.post("/analyze")
 def analyze_directory(req: AnalyzeRequest):
+    if serving.READ_ONLY:
+        return to_writer("POST", "/analyze", body=req.dict(exclude_none=True))
     print("Procesando ruta:", req.path)
-    global DOCS_DIR, processing_status
+    global DOCS_DIR
+    name = req.collection or DEFAULT_COLLECTION
+    coll = get_collection(name)
     DOCS_DIR = req.path
     files = glob.glob(
         os.path.join(DOCS_DIR, "**", "*.pdf"), recursive=True
     ) + glob.glob(os.path.join(DOCS_DIR, "**", "*.docx"), recursive=True)
-    processing_status.update(
-        {"progress": 0, "total": len(files), "done": False, "message": "Processing..."}
+    # Solo stat(): los archivos sin cambios no se leen
+    scan = coll.manifest.scan(files, root=DOCS_DIR)
+    todo = scan["new"] + scan["modified"]
+    # Solo el estado de esa colección: ingerir en otra no frena /chat sobre la de por defecto
+    jobs.status_for(name).update(
+        {"progress": 0, "total": len(todo), "done": False, "message": "Processing..."}
     )
+    params = req.dict(exclude={"path"}, exclude_none=True)
+    # Los archivos borrados de la carpeta se quitan del índice dentro del mismo job
+    if scan["deleted"]:
+        params["deleted"] = scan["deleted"]
+    job_id = jobs.submit(DOCS_DIR, todo, params)
+    return {
+        "message": f"Started processing {len(todo)} files.",
+        "job_id": job_id,
+        **{k: len(v) for k, v in scan.items()},
+    }
+
+def get_collection(name):
+    try:
+        return catalog.get(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Collection not found: {name}")
+
+def target(collections=None):
+    # Colecciones de la consulta -> (nombres, colección o grupo donde buscar)
+    names = tuple(dict.fromkeys(collections or [DEFAULT_COLLECTION]))
+    missing = [n for n in names if not catalog.exists(n)]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Collection not found: {', '.join(missing)}")
+    return names, catalog.view(names)
+
+class CollectionRequest(BaseModel):
+    name: str
+    shards: int = 1
+    index_type: Optional[str] = None
+
+@app.get("/collections")
+def list_collections():
+    catalog.refresh()
+    return {"collections": catalog.stats(), "memory_mb": round(catalog.memory_bytes() / 2**20, 2)}
+
+@app.post("/collections")
+def create_collection(req: CollectionRequest):
+    if serving.READ_ONLY:
+        return to_writer("POST", "/collections", body=req.dict(exclude_none=True))
+    try:
+        catalog.create(req.name, shards=req.shards, index_type=req.index_type)
+    except CollectionError as e:
+        raise HTTPException(status_code=409 if catalog.exists(req.name) else 400, detail=str(e))
+    return {"message": f"Collection {req.name} created", "name": req.name, "shards": req.shards}
+
+@app.delete("/collections/{name}")
+def delete_collection(name: str):
+    if serving.READ_ONLY:
+        return to_writer("DELETE", f"/collections/{name}")
+    if not catalog.exists(name):
+        raise HTTPException(status_code=404, detail=f"Collection not found: {name}")
+    try:
+        jobs.reset(lambda: catalog.drop(name), collection=name)
+    except CollectionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"message": f"Collection {name} deleted"}
+
+@app.delete("/documents/{source:path}")
+def delete_document(source: str, collection: str = DEFAULT_COLLECTION):
+    # Borra un documento por su ruta, o por su nombre de archivo si ningún otro se llama igual.
+    # El borrado es un job más: lo ejecuta el mismo escritor que la ingesta
+    if serving.READ_ONLY:
+        return to_writer("DELETE", f"/documents/{source}", params={"collection": collection})
+    coll = get_collection(collection)
+    paths = [source] if coll.manifest.get(source) else coll.manifest.find(source)
+    if not paths:
+        raise HTTPException(status_code=404, detail=f"Document not found: {source}")
+    if len(paths) > 1:
+        raise HTTPException(
+            status_code=409, detail=f"Hay {len(paths)} documentos llamados {source}; usar la ruta completa: {paths}",
+        )
+    # Se olvida en el manifest (un /analyze posterior lo vuelve a ingerir) y se borran sus chunks,
+    # salvo que otro archivo registrado tenga el mismo contenido
+    job_id = jobs.submit(os.path.dirname(paths[0]), [], {"collection": collection, "deleted": paths})
+    return {"message": f"Removing document {paths[0]}", "job_id": job_id, "path": paths[0]}
+
+@app.get("/jobs")
+def list_jobs():
+    if serving.READ_ONLY:
+        return to_writer("GET", "/jobs")
+    return {"jobs": jobs.list(), "current": jobs.current}
 
-    def process_files():
-        known = set([c.get("hash") for c in vs.data if c.get("hash")])
-        print(f"Entró a process_files")
-        print(f"Archivos a procesar: {files}")
-        for i, f in enumerate(files):
-            print(f"Procesando archivo {i+1}/{len(files)}: {f}")
-            with open(f, "rb") as fin:
-                h = hashlib.md5(fin.read()).hexdigest()
-            if h in known:
-                processing_status["progress"] = int(100 * (i + 1) / len(files))
-                continue
-            chunks = extract_text_and_images(f)
-            if not chunks:
-                print(f"Archivo vacío o sin texto: {f}")
-                processing_status["progress"] = int(100 * (i + 1) / len(files))
-                continue
-            for c in chunks:
-                c["hash"] = h
-            texts = [c["text"] for c in chunks]
-            embeddings = embed_texts(texts)
-            print(f"FAISS espera dimensión: {vs.index.d}")
-            print(f"Embeddings tienen shape: {getattr(embeddings, 'shape', None)}")
-            if hasattr(embeddings, "shape"):
-                if embeddings.shape[1] != vs.index.d:
-                    print(
-                        f"ERROR: El embedding shape {embeddings.shape[1]} no coincide con FAISS ({vs.index.d}) en archivo {f}"
-                    )
-                    processing_status["progress"] = int(100 * (i + 1) / len(files))
-                    continue
-                if len(embeddings) != len(chunks):
-                    print(
-                        f"SKIP: embeddings ({len(embeddings)}) y chunks ({len(chunks)}) no coinciden en {f}"
-                    )
-                    processing_status["progress"] = int(100 * (i + 1) / len(files))
-                    continue
-            else:
-                print(f"ERROR: embeddings no tiene shape en archivo {f}")
-                processing_status["progress"] = int(100 * (i + 1) / len(files))
-                continue
-            vs.add(embeddings, chunks)
-            processing_status["progress"] = int(100 * (i + 1) / len(files))
-        processing_status["done"] = True
-        processing_status["message"] = "Ready"
-
-    threading.Thread(target=process_files).start()
-    return {"message": f"Started processing {len(files)} files."}
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    if serving.READ_ONLY:
+        return to_writer("GET", f"/jobs/{job_id}")
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    if serving.READ_ONLY:
+        return to_writer("POST", f"/jobs/{job_id}/cancel")
+    job = jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
 
 @app.get("/progress")
-def get_progress():
+def get_progress(collection: str = DEFAULT_COLLECTION):
+    if collection != DEFAULT_COLLECTION:
+        # Los lectores solo publican el estado de la colección por defecto
+        if serving.READ_ONLY:
+            return to_writer("GET", "/progress", params={"collection": collection})
+        return collection_status(collection)
     # Asegúrate de checar si el vs tiene data después de reiniciar
+    catalog.refresh()
+    status = current_status()
     if vs.has_knowledge():
-        processing_status.update({"done": True, "message": "Ready"})
-    return processing_status
+        status.update({"done": True, "message": "Ready"})
+    return status
+
+def collection_status(name):
+    # Estado de ingesta de una colección que no es la por defecto
+    coll = get_collection(name)
+    if serving.READ_ONLY:
+        # El escritor no publica estos estados: lista si ya tiene datos
+        return {"done": coll.has_knowledge()}
+    new = name not in jobs.statuses
+    status = jobs.status_for(name)
+    if new and coll.has_knowledge():
+        # Sin jobs desde que arrancó el proceso: lista si ya tiene datos
+        status.update({"done": True, "message": "Ready"})
+    return status
+
+def check_ready(collections=None):
+    # Cada colección de la consulta tiene que haber terminado su ingesta; sin colecciones,
+    # la por defecto (la ingesta en una no frena el chat sobre las demás)
+    for name in dict.fromkeys(collections or [DEFAULT_COLLECTION]):
+        status = current_status() if name == DEFAULT_COLLECTION else collection_status(name)
+        if not status.get("done"):
+            raise HTTPException(status_code=400, detail="Processing not finished.")
 
 class ChatQuery(BaseModel):
     question: str
     lang: Optional[str] = None
+    # Devuelve el desglose de tiempos por etapa junto con la respuesta
+    profile: bool = False
+    # Colecciones donde buscar (por defecto, "default")
+    collections: Optional[List[str]] = None
+    # Idioma en la búsqueda: "restrict" (solo chunks del idioma de la pregunta), "boost" u "off";
+    # por defecto VS_LANG_MODE
+    lang_mode: Optional[str] = None
+
+async def call_ollama_mistral(context: str, question: str, lang: str = "en"):
+    # Devuelve (respuesta, conteos de tokens y tiempos que reporta Ollama)
+    usage = {}
+    async with llm_limiter.slot():
+        try:
+            with metrics.span("llm"):
+                answer = await generate(build_prompt(context, question), stats=usage)
+        except Exception as e:
+            return f"Error comunicando con Ollama: {e}", usage
+    count_usage(usage)
+    return answer, usage
+
+def count_usage(usage):
+    for key in ("prompt_tokens", "completion_tokens"):
+        if usage.get(key):
+            metrics.inc(f"llm_{key}_total", usage[key])
+
+def embed_question(question):
+    norm = normalize_question(question)
+    q_emb = qcache.embeddings.get(norm)
+    if q_emb is None:
+        with metrics.span("query_embed"):
+            q_emb = embed_texts([question])[0]
+        qcache.embeddings.put(norm, q_emb)
+    return norm, q_emb
+
+def check_lang_mode(lang_mode):
+    if lang_mode is not None and lang_mode not in LANG_MODES:
+        raise HTTPException(status_code=400, detail=f"lang_mode inválido: {lang_mode!r} ({', '.join(LANG_MODES)})")
 
-def call_ollama_mistral(context: str, question: str, lang: str = "en") -> str:
-    prompt = f"""
-Contesta en el idioma detectado del usuario.
-Contexto extraído de documentos:
-{context}
-
-Pregunta del usuario:
-{question}
-
-Responde de forma precisa y solo usa la información relevante del contexto. Si no hay información suficiente, di que no la encontraste.
-"""
-    payload = {
-        "model": "mistral",
-        "prompt": prompt,
-        "stream": False,
-        "options": {"temperature": 0.2},
+def retrieve(question, top_k=5, names=(DEFAULT_COLLECTION,), store=None, lang=None, lang_mode=None):
+    # Devuelve (versión del índice, pregunta normalizada, ids de los top_k chunks)
+    # Workers de solo lectura: primero se toma el último índice publicado
+    catalog.refresh()
+    qcache.check_version()
+    # Las colecciones consultadas son parte de la versión: ids iguales en otra colección son otros chunks
+    version = (catalog.version, names)
+    norm, q_emb = embed_question(question)
+    # La parte léxica depende del texto, no solo del embedding
+    rkey = (version, norm, lang, lang_mode) + embedding_key(q_emb, top_k)
+    ids = qcache.results.get(rkey)
+    if ids is None:
+        ids = (store or vs).search_ids(q_emb, top_k=top_k, query_text=question, lang=lang, lang_mode=lang_mode)
+        qcache.results.put(rkey, ids)
+    return version, norm, ids
+
+def retrieve_batch(questions, top_k=5, names=(DEFAULT_COLLECTION,), store=None, langs=None, lang_mode=None):
+    # Igual que retrieve() pero con un solo model.encode y un solo index.search para todo el lote
+    catalog.refresh()
+    qcache.check_version()
+    version = (catalog.version, names)
+    norms = [normalize_question(q) for q in questions]
+    embs = [qcache.embeddings.get(n) for n in norms]
+    # Preguntas repetidas dentro del lote se codifican una sola vez
+    missing = {}
+    for i, e in enumerate(embs):
+        if e is None:
+            missing.setdefault(norms[i], i)
+    if missing:
+        with metrics.span("query_embed"):
+            new_embs = embed_texts([questions[i] for i in missing.values()], batch_size=64)
+        found = dict(zip(missing, new_embs))
+        for norm, e in found.items():
+            qcache.embeddings.put(norm, e)
+        embs = [found[n] if e is None else e for n, e in zip(norms, embs)]
+    langs = langs or [None] * len(questions)
+    rkeys = [(version, n, l, lang_mode) + embedding_key(e, top_k) for n, e, l in zip(norms, embs, langs)]
+    ids = [qcache.results.get(k) for k in rkeys]
+    missing = [i for i, x in enumerate(ids) if x is None]
+    if missing:
+        found = (store or vs).search_ids_batch(
+            [embs[i] for i in missing], top_k=top_k, query_texts=[questions[i] for i in missing],
+            langs=[langs[i] for i in missing], lang_mode=lang_mode,
+        )
+        for i, x in zip(missing, found):
+            ids[i] = x
+            qcache.results.put(rkeys[i], x)
+    return [(version, n, x) for n, x in zip(norms, ids)]
+
+def chunk_source(c):
+    page = c.get("page")
+    return f"{c['source']} (p. {page})" if page else c["source"]
+
+def context_entry(c):
+    if c.get("is_image", False):
+        return f"[Imagen OCR de {chunk_source(c)}]: {c['text']}\n"
+    return f"[De {chunk_source(c)}]: {c['text']}\n"
+
+def image_url(path):
+    return f"/{path}" if not path.startswith("/") else path
+
+def image_ref(c):
+    # "thumb": miniatura generada al ingerir (chunks anteriores: la imagen original)
+    return {
+        "src": image_url(c["image_path"]),
+        "thumb": image_url(c.get("thumb_path") or c["image_path"]),
+        "source": c["source"],
+        "page": c.get("page", None),
     }
-    try:
-        response = requests.post(OLLAMA_API_URL, json=payload, timeout=60)
-        response.raise_for_status()
-        res_json = response.json()
-        return res_json.get("response", "").strip()
-    except Exception as e:
-        return f"Error comunicando con Ollama: {e}"
 
-@app.post("/chat")
-def chat(query: ChatQuery):
-    if not processing_status.get("done"):
-        raise HTTPException(status_code=400, detail="Processing not finished.")
-    qlang = query.lang or detect_language(query.question)
-    q_emb = embed_texts([query.question])[0]
-    results = vs.search(q_emb, top_k=5)
+def build_context(results, duplicates=()):
     context, images, sources = "", [], []
     for c in results:
-        page = c.get("page")
-        src = f"{c['source']} (p. {page})" if page else c["source"]
-
+        context += context_entry(c)
         if c.get("is_image", False):
-            context += f"[Imagen OCR de {src}]: {c['text']}\n"
-            images.append(
-                {
-                    "src": (
-                        f"/{c['image_path']}"
-                        if not c["image_path"].startswith("/")
-                        else c["image_path"]
-                    ),
-                    "source": c["source"],
-                    "page": c.get("page", None),
-                }
-            )
-        else:
-            context += f"[De {src}]: {c['text']}\n"
-        sources.append(src)
+            images.append(image_ref(c))
+        sources.append(chunk_source(c))
+    # Una imagen cuyo OCR repite texto ya incluido no entra al prompt, pero se sigue mostrando
+    for c in duplicates:
+        if c.get("is_image", False) and c.get("image_path"):
+            images.append(image_ref(c))
+    return context, images, list(set(sources))
+
+def fetch_context(ids, chunk_map=None, vectors=None, max_chunks=None, store=None):
+    # Candidatos -> sin casi-duplicados -> MMR -> presupuesto de tokens
+    with metrics.span("context"):
+        if chunk_map is None:
+            store = store or vs
+            chunk_map, vectors = store.get_chunk_map(ids), store.get_vectors(ids)
+        selected, duplicates, stats = assemble(ids, chunk_map, vectors, context_entry, max_chunks=max_chunks)
+        context, images, sources = build_context([c for _, c in selected], duplicates)
+        return context, images, sources, {**stats, "ids": [i for i, _ in selected]}
+
+def question_language(query):
+    # None si no se reconoce el idioma: la búsqueda no se restringe ni favorece ninguno
+    if query.lang:
+        return query.lang
+    with metrics.span("language_detect"):
+        return detect_language(query.question, default=None)
+
+def with_profile(response, timings, start):
+    profile = {"stages_ms": metrics.summarize(timings), "total_ms": round(1000 * (time.perf_counter() - start), 3)}
+    return {**response, "profile": profile}
+
+@app.post("/chat")
+async def chat(query: ChatQuery):
+    check_ready(query.collections)
+    metrics.inc("chat_requests_total", endpoint="chat")
+    start = time.perf_counter()
+    with metrics.profile() as timings:
+        response = await answer_question(query)
+    metrics.observe("request_seconds", time.perf_counter() - start, endpoint="chat")
+    return with_profile(response, timings, start) if query.profile else response
+
+async def answer_question(query):
+    check_lang_mode(query.lang_mode)
+    # Embedding, FAISS y SQLite fuera del event loop
+    names, store = await run_in_threadpool(target, query.collections)
+    qlang = question_language(query)
+    version, norm, ids = await run_in_threadpool(
+        retrieve, query.question, CONTEXT_CANDIDATES, names, store, qlang, query.lang_mode,
+    )
+    # El mismo id de candidatos con otro tope de chunks es otro contexto: otra respuesta
+    akey = (version, norm, query.lang, tuple(ids), CONTEXT_MAX_CHUNKS)
+    cached = qcache.get_answer(akey)
+    if cached is not None:
+        return cached
+    context, images, sources, usage = await run_in_threadpool(
+        fetch_context, ids, max_chunks=CONTEXT_MAX_CHUNKS, store=store,
+    )
+    del usage["ids"]
     if not context:
         answer = "No se encontró información relevante en los documentos."
     else:
-        answer = call_ollama_mistral(context, query.question, lang=qlang)
-
-    print("DEBUG APP.PY IMGS:", images)
+        usage["prompt_tokens_est"] = count_tokens(build_prompt(context, query.question))
+        try:
+            # Preguntas idénticas en vuelo comparten una sola generación
+            answer, llm_usage = await coalescer.run(
+                akey, lambda: call_ollama_mistral(context, query.question, lang=qlang)
+            )
+        except LLMBusy as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": "5"})
+        usage.update(llm_usage)
 
-    return {
+    response = {
         "answer": answer,
         "images": images,
-        "sources": list(set(sources))
+        "sources": sources,
+        "usage": usage,
     }
+    if not answer.startswith("Error comunicando con Ollama"):
+        qcache.put_answer(akey, response)
+    return response
 
-@app.get("/images/{filename}")
-def get_image(filename: str):
-    img_path = os.path.join("storage", "images", filename)
-    if os.path.exists(img_path):
-        return FileResponse(img_path)
-    return {"error": "not found"}
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", 1000))
+
+async def answer_batch(questions, top_k=5, lang=None, retrieval_only=False, concurrency=None, collections=None,
+                       lang_mode=None):
+    """API de Python para lotes: devuelve un resultado por pregunta, en el mismo orden."""
+    metrics.inc("chat_requests_total", endpoint="batch")
+    start = time.perf_counter()
+    names, store = await run_in_threadpool(target, collections)
+    with metrics.span("language_detect"):
+        langs = [lang or detect_language(q, default=None) for q in questions]
+    # top_k es el máximo de chunks en el contexto; se traen más candidatos para elegir
+    retrieved = await run_in_threadpool(
+        retrieve_batch, questions, max(top_k, CONTEXT_CANDIDATES), names, store, langs, lang_mode,
+    )
+    all_ids = sorted({i for _, _, ids in retrieved for i in ids})
+    by_id = await run_in_threadpool(store.get_chunk_map, all_ids)
+    vectors = await run_in_threadpool(store.get_vectors, all_ids)
+    sem = asyncio.Semaphore(concurrency or llm_limiter.concurrency)
+
+    async def one(question, version, norm, ids):
+        # SQLite, MMR y conteo de tokens: fuera del event loop, como la recuperación
+        context, images, sources, usage = await run_in_threadpool(
+            fetch_context, ids, by_id, vectors, max_chunks=top_k,
+        )
+        selected = usage.pop("ids")
+        result = {"question": question, "images": images, "sources": sources, "usage": usage}
+        if retrieval_only:
+            result["chunks"] = [
+                {"id": i, "text": by_id[i]["text"], "source": by_id[i]["source"], "page": by_id[i].get("page")}
+                for i in selected
+            ]
+            return result
+        akey = (version, norm, lang, tuple(ids), top_k)
+        cached = qcache.get_answer(akey)
+        if cached is not None:
+            return {**result, "answer": cached["answer"], "usage": cached.get("usage", usage)}
+        if not context:
+            return {**result, "answer": "No se encontró información relevante en los documentos."}
+        usage["prompt_tokens_est"] = count_tokens(build_prompt(context, question))
+        async with sem:
+            try:
+                answer, llm_usage = await coalescer.run(
+                    akey, lambda: call_ollama_mistral(context, question, lang=lang)
+                )
+            except LLMBusy as e:
+                return {**result, "error": e.detail, "status": e.status_code}
+        if answer.startswith("Error comunicando con Ollama"):
+            return {**result, "error": answer}
+        usage.update(llm_usage)
+        qcache.put_answer(akey, {"answer": answer, "images": images, "sources": sources, "usage": usage})
+        return {**result, "answer": answer}
+
+    results = await asyncio.gather(*[one(q, *r) for q, r in zip(questions, retrieved)])
+    metrics.observe("request_seconds", time.perf_counter() - start, endpoint="batch")
+    return results
+
+class BatchQuery(BaseModel):
+    questions: List[str]
+    top_k: int = 5
+    lang: Optional[str] = None
+    retrieval_only: bool = False
+    concurrency: Optional[int] = None
+    collections: Optional[List[str]] = None
+    lang_mode: Optional[str] = None
+
+@app.post("/chat/batch")
+async def chat_batch(query: BatchQuery):
+    check_ready(query.collections)
+    if not query.questions:
+        return {"results": []}
+    if len(query.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BATCH_MAX_QUESTIONS} preguntas por lote.")
+    check_lang_mode(query.lang_mode)
+    results = await answer_batch(
+        query.questions, top_k=query.top_k, lang=query.lang,
+        retrieval_only=query.retrieval_only, concurrency=query.concurrency,
+        collections=query.collections, lang_mode=query.lang_mode,
+    )
+    return {"results": results}
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(query: ChatQuery, request: Request):
+    # Server-sent events: primero fuentes/imágenes, luego los tokens de Ollama, al final tiempos
+    check_ready(query.collections)
+    check_lang_mode(query.lang_mode)
+    metrics.inc("chat_requests_total", endpoint="stream")
+    start = time.perf_counter()
+    with metrics.profile() as timings:
+        names, store = await run_in_threadpool(target, query.collections)
+        qlang = question_language(query)
+        version, norm, ids = await run_in_threadpool(
+            retrieve, query.question, CONTEXT_CANDIDATES, names, store, qlang, query.lang_mode,
+        )
+        akey = (version, norm, query.lang, tuple(ids), CONTEXT_MAX_CHUNKS)
+        cached = qcache.get_answer(akey)
+        if cached is None:
+            context, images, sources, usage = await run_in_threadpool(
+                fetch_context, ids, max_chunks=CONTEXT_MAX_CHUNKS, store=store,
+            )
+            del usage["ids"]
+            if context:
+                usage["prompt_tokens_est"] = count_tokens(build_prompt(context, query.question))
+        else:
+            context, images, sources, usage = None, cached["images"], cached["sources"], cached.get("usage")
+    if cached is None and context:
+        try:
+            llm_limiter.check()
+        except LLMBusy as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": "5"})
+
+    def ms():
+        return 1000 * (time.perf_counter() - start)
+
+    def done(ttft_ms):
+        # El generador corre en otra tarea: los tiempos del LLM se agregan a mano al perfil
+        metrics.observe("request_seconds", ms() / 1000, endpoint="stream")
+        data = {"ttft_ms": ttft_ms, "total_ms": ms(), "usage": usage}
+        if query.profile:
+            data["profile"] = {"stages_ms": metrics.summarize(timings)}
+        return sse("done", data)
+
+    async def events():
+        yield sse("meta", {"sources": sources, "images": images, "cached": cached is not None, "usage": usage})
+        if cached is not None or not context:
+            answer = cached["answer"] if cached is not None else "No se encontró información relevante en los documentos."
+            yield sse("token", {"t": answer})
+            yield done(ms())
+            return
+        parts, ttft, llm_usage = [], None, {}
+        try:
+            async with llm_limiter.slot():
+                llm_start = time.perf_counter()
+                # aclosing: al salir (también por desconexión) se cierra el stream de Ollama en
+                # el momento, sin esperar al recolector, y Ollama deja de generar
+                gen = stream_generate(build_prompt(context, query.question), stats=llm_usage)
+                async with contextlib.aclosing(gen):
+                    async for token in gen:
+                        if ttft is None:
+                            ttft = ms()
+                            metrics.record("llm_ttft", time.perf_counter() - llm_start, timings)
+                        parts.append(token)
+                        yield sse("token", {"t": token})
+                        if await request.is_disconnected():
+                            return
+        except LLMBusy as e:
+            yield sse("error", {"status": e.status_code, "detail": e.detail})
+            return
+        except Exception as e:
+            yield sse("error", {"detail": f"Error comunicando con Ollama: {e}"})
+            return
+        metrics.record("llm", time.perf_counter() - llm_start, timings)
+        count_usage(llm_usage)
+        usage.update(llm_usage)
+        qcache.put_answer(akey, {"answer": "".join(parts).strip(), "images": images, "sources": sources, "usage": usage})
+        yield done(ttft or ms())
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_async_client()
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {**qcache.stats(), "llm": llm_limiter.stats(), "coalesced": coalescer.coalesced}
+
+@app.get("/metrics")
+def get_metrics():
+    catalog.refresh()
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.api_route("/images/{name:path}", methods=["GET", "HEAD"])
+def get_image(name: str, request: Request):
+    # Imágenes por hash: ETag fuerte, caché inmutable, 304 y rangos
+    result = image_store.respond(name, request.headers, head=request.method == "HEAD")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    status, headers, body = result
+    return Response(content=body, status_code=status, headers=headers)
 
 @app.post("/reset")
-def reset_vector_store():
-    global vs, processing_status
-    vs.reset()
-    processing_status = {"progress": 0, "total": 0, "done": False, "message": ""}
+def reset_vector_store(collection: str = DEFAULT_COLLECTION):
+    if serving.READ_ONLY:
+        return to_writer("POST", "/reset", params={"collection": collection})
+    # Vacía una sola colección (por defecto, la de siempre); las demás no se tocan
+    get_collection(collection)
+
+    def reset():
+        catalog.reset(collection)
+        # Se actualiza en su lugar: el JobManager comparte el mismo dict
+        status = jobs.status_for(collection)
+        status.clear()
+        status.update({"progress": 0, "total": 0, "done": False, "message": ""})
+
+    # Cancela los jobs de la colección y espera a que el escritor suelte el índice
+    jobs.reset(reset, collection=collection)
     return {"message": "Vector store reset, ready to process new files"}
@@ -0,0 +1,105 @@
+import os
+import io
+import random
+import argparse
+
+from fpdf import FPDF
+from PIL import Image, ImageDraw
+
+# Mismos temas que test-imports.py; el texto se arma con plantillas y valores al azar
+TOPICS = [
+    "Braking Systems",
+    "Interior Ergonomics",
+    "Chassis Stiffness",
+    "Crash Safety Design",
+    "Electrical Wiring",
+    "Aerodynamics",
+    "Lighting Systems",
+    "Engine Bay Layout",
+    "HVAC System Integration",
+    "Noise & Vibration Control",
+]
+
+TEMPLATES = [
+    "Apply {a}-{b}Nm for M{m} bolts in {part} mounting. Over/under torque risks loosening or thread damage.",
+    "Maintain minimum clearance of {a}mm from all moving {part} elements. Incorrect routing can cause abrasion.",
+    "{part} bolts must be minimum grade {g}. Lower grades risk fatigue failure under cyclic load.",
+    "Keep {part} travel between {a}-{b}mm for optimal ergonomics and fast reaction time.",
+    "All {part} connectors IP{ip} or better. Lower ratings allow water ingress.",
+    "Design {part} to achieve at least {n} Nm/degree torsional rigidity. Low stiffness results in poor handling.",
+    "Provide {a}-{b}mm drain holes at low points of the {part}.",
+    "Max {db}dBA at full {part} load measured at the driver ear position.",
+]
+
+PARTS = ["brake caliper", "suspension", "chassis", "harness", "seat", "door", "radiator", "headlamp", "HVAC duct", "firewall"]
+
+SPANISH_NOTE = (
+    "Nota adicional: {topic} requiere validaciones y revisiones constantes para adaptarse a "
+    "normativas internacionales. Mantén la documentación de cambios en el diseño."
+)
+
+
+def _sentence(rng):
+    a = rng.randint(2, 90)
+    return rng.choice(TEMPLATES).format(
+        a=a, b=a + rng.randint(5, 20), m=rng.choice([6, 8, 10, 12]), part=rng.choice(PARTS),
+        g=rng.choice(["8.8", "10.9", "12.9"]), ip=rng.choice([54, 65, 67, 69]),
+        n=rng.randint(10, 30) * 1000, db=rng.randint(40, 60),
+    )
+
+
+def _diagram(rng, label):
+    # Imagen con texto para que el OCR tenga algo que leer
+    img = Image.new("RGB", (480, 200), "white")
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        x, y = rng.randint(0, 400), rng.randint(60, 160)
+        draw.rectangle([x, y, x + rng.randint(20, 80), y + rng.randint(10, 40)], outline="black")
+    draw.text((10, 10), label, fill="black")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    buf.seek(0)
+    return buf
+
+
+def generate_corpus(out_dir, n_docs=50, pages=2, sections=8, images_per_doc=1, shared_logo=True, seed=0):
+    """Genera n_docs PDFs sintéticos en out_dir y devuelve sus rutas."""
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    logo = _diagram(random.Random(-1), "GM BEST PRACTICES") if shared_logo else None
+    paths = []
+    for d in range(n_docs):
+        topic = TOPICS[d % len(TOPICS)]
+        pdf = FPDF()
+        pdf.set_auto_page_break(auto=True, margin=15)
+        for p in range(pages):
+            pdf.add_page()
+            if logo is not None:
+                # El mismo logo en cada página (caso típico para el dedup de imágenes)
+                logo.seek(0)
+                pdf.image(logo, x=150, y=5, w=50)
+            pdf.set_font("Helvetica", "B", 16)
+            pdf.cell(0, 12, f"Best Practices in {topic} ({d + 1}.{p + 1})", new_x="LMARGIN", new_y="NEXT", align="C")
+            pdf.set_font("Helvetica", "", 11)
+            for s in range(sections):
+                pdf.multi_cell(0, 6, f"{s + 1}. {_sentence(rng)}")
+                pdf.ln(1)
+            pdf.multi_cell(0, 6, SPANISH_NOTE.format(topic=topic))
+            if p < images_per_doc:
+                pdf.image(_diagram(rng, f"{topic} fig {d}-{p}: {_sentence(rng)[:40]}"), w=120)
+        path = os.path.join(out_dir, f"best_practices_synth_{d + 1:05d}.pdf")
+        pdf.output(path)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera un corpus sintético de PDFs")
+    parser.add_argument("out_dir")
+    parser.add_argument("--docs", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=2)
+    parser.add_argument("--images-per-doc", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    paths = generate_corpus(args.out_dir, args.docs, args.pages, images_per_doc=args.images_per_doc, seed=args.seed)
+    print(f"{len(paths)} PDFs en {args.out_dir}")
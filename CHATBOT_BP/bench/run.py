@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import defaultdict
+
+import numpy as np
+
+# Se corre desde CHATBOT_BP:  python -m bench.run --suite ingest,retrieval,chat
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+
+def percentiles(values_ms):
+    arr = np.asarray(values_ms, dtype="float64")
+    if arr.size == 0:
+        return {}
+    return {
+        "count": int(arr.size),
+        "mean_ms": float(arr.mean()),
+        "p50_ms": float(np.percentile(arr, 50)),
+        "p95_ms": float(np.percentile(arr, 95)),
+        "p99_ms": float(np.percentile(arr, 99)),
+        "max_ms": float(arr.max()),
+    }
+
+
+class Timer:
+    def __init__(self):
+        self.totals = defaultdict(float)
+
+    def __call__(self, stage):
+        timer = self
+
+        class _Span:
+            def __enter__(self):
+                self.start = time.perf_counter()
+
+            def __exit__(self, *exc):
+                timer.totals[stage] += time.perf_counter() - self.start
+
+        return _Span()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+# ---------------------------------------------------------------- ingesta
+
+def bench_ingest(args, work):
+    import fitz
+    from bench.corpus import generate_corpus
+    from modules.manifest import hash_file
+    from modules.ocr import OcrEngine, OcrCache, image_hash
+    from modules.chunker import split_chunks
+    from modules.embedder import embed_texts, get_tokenizer, max_tokens
+    from modules.vector_store import VectorStore
+    from modules.pipeline import IngestPipeline
+
+    files = generate_corpus(os.path.join(work, "corpus"), args.docs, args.pages, images_per_doc=args.images_per_doc)
+    timer = Timer()
+    ocr = OcrEngine(cache=OcrCache(os.path.join(work, "ocr_cache.sqlite")))
+    chunks = []
+    n_images = n_unique_images = 0
+    for f in files:
+        with timer("hash"):
+            hash_file(f)
+        with timer("pdf_text"):
+            doc = fitz.open(f)
+            for page_num, page in enumerate(doc, 1):
+                text = page.get_text()
+                if text.strip():
+                    chunks.append({"text": text, "source": os.path.basename(f), "page": page_num})
+        with timer("image_extract"):
+            images = {}
+            for page in doc:
+                for img_info in page.get_images(full=True):
+                    n_images += 1
+                    img_bytes = doc.extract_image(img_info[0])["image"]
+                    images[image_hash(img_bytes)] = img_bytes
+            n_unique_images += len(images)
+        with timer("ocr"):
+            for h, text in ocr.run(images).items():
+                if text:
+                    chunks.append({"text": text, "source": os.path.basename(f), "page": None, "is_image": True})
+    with timer("chunking"):
+        pieces = [p for ps in split_chunks(chunks, get_tokenizer(), max_tokens()) for p in ps]
+    embeddings = []
+    for i in range(0, len(pieces), args.batch_size):
+        batch = pieces[i:i + args.batch_size]
+        with timer("embed"):
+            embeddings.append(embed_texts([p["text"] for p in batch], batch_size=args.batch_size))
+    embeddings = np.concatenate(embeddings)
+    vs = VectorStore(dim=embeddings.shape[1], root=os.path.join(work, "vs_ingest"))
+    per_file = max(1, len(pieces) // max(1, len(files)))
+    for i in range(0, len(pieces), per_file):
+        with timer("index_add"):
+            vs.add(embeddings[i:i + per_file], pieces[i:i + per_file])
+    with timer("persist_compaction"):
+        vs.compact()
+
+    # Pipeline completo (procesos + lotes + escritor único)
+    status = {}
+    vs2 = VectorStore(dim=embeddings.shape[1], root=os.path.join(work, "vs_pipeline"))
+    start = time.perf_counter()
+    IngestPipeline(vs2, status, workers=args.workers, batch_size=args.batch_size).run(files)
+    pipeline_s = time.perf_counter() - start
+
+    stages = dict(timer.totals)
+    return {
+        "docs": len(files),
+        "pages": len(files) * args.pages,
+        "images": n_images,
+        "unique_images": n_unique_images,
+        "chunks": len(pieces),
+        "stage_seconds": stages,
+        "stage_docs_per_s": {k: len(files) / v for k, v in stages.items() if v > 0},
+        "sequential_docs_per_s": len(files) / sum(stages.values()),
+        "pipeline": {
+            "workers": args.workers,
+            "seconds": pipeline_s,
+            "docs_per_s": len(files) / pipeline_s,
+            "chunks_indexed": int(vs2.index.ntotal),
+        },
+    }
+
+
+# ---------------------------------------------------------------- recuperación
+
+def synthetic_vectors(n, dim, n_clusters, rng):
+    # Mezcla de gaussianas normalizada: más parecida a embeddings reales que ruido uniforme
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    labels = rng.integers(0, n_clusters, n)
+    x = centers[labels] + 0.35 * rng.standard_normal((n, dim)).astype("float32")
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x
+
+
+def bench_retrieval(args, work):
+    import faiss
+    import modules.vector_store as vsmod
+
+    rng = np.random.default_rng(args.seed)
+    dim = args.dim
+    base = synthetic_vectors(args.vectors, dim, max(16, args.vectors // 500), rng)
+    picks = rng.integers(0, args.vectors, args.queries)
+    queries = base[picks] + 0.1 * rng.standard_normal((args.queries, dim)).astype("float32")
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact = faiss.IndexFlatIP(dim)
+    exact.add(base)
+    _, gt = exact.search(queries, args.top_k)
+
+    results = {
+        "vectors": args.vectors, "dim": dim, "queries": args.queries, "top_k": args.top_k,
+        "recall_tolerance": args.recall_tolerance, "modes": {},
+    }
+    for mode in args.index_modes:
+        root = os.path.join(work, f"vs_{mode}")
+        vs = vsmod.VectorStore(dim=dim, root=root, index_type=mode)
+        start = time.perf_counter()
+        step = 50_000
+        for i in range(0, args.vectors, step):
+            vs.add(base[i:i + step], [{"text": "", "source": "synthetic"}] * len(base[i:i + step]))
+        vs.compact()
+        build_s = time.perf_counter() - start
+
+        lat = []
+        found = []
+        for q in queries:
+            t0 = time.perf_counter()
+            ids = vs.search_ids(q, top_k=args.top_k)
+            lat.append(1000 * (time.perf_counter() - t0))
+            found.append(ids)
+        t0 = time.perf_counter()
+        vs.search_ids_batch(queries, top_k=args.top_k)
+        batch_s = time.perf_counter() - t0
+
+        # La referencia es el flat exacto: recall 1.0
+        recall = float(np.mean([len(set(f) & set(g)) / args.top_k for f, g in zip(found, gt)]))
+        index_bytes = faiss.serialize_index(vs.index).nbytes
+        n = max(1, vs.index.ntotal)
+        results["modes"][mode] = {
+            "index_kind": vsmod._index_kind(vs.index),
+            "build_s": build_s,
+            "latency": percentiles(lat),
+            "batch_qps": args.queries / batch_s,
+            f"recall@{args.top_k}": recall,
+            "recall_loss_vs_flat": 1.0 - recall,
+            "within_tolerance": 1.0 - recall <= args.recall_tolerance,
+            "index_bytes": index_bytes,
+            "bytes_per_vector": index_bytes / n,
+            # Memoria residente por millón de chunks (índice en RAM)
+            "mb_per_million": index_bytes / n * 1e6 / 2**20,
+            "memory_mb_per_million": vs.memory_bytes() / n * 1e6 / 2**20,
+            # Vectores exactos para el re-ranking: en disco, leídos con mmap
+            "disk_mb_per_million": os.path.getsize(vs.vectors.path) / n * 1e6 / 2**20,
+        }
+        vs.close()
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+# ---------------------------------------------------------------- chat de punta a punta
+
+def bench_chat(args, work):
+    from bench.stub_ollama import start_stub, serve_in_thread
+    from bench.corpus import generate_corpus
+
+    url, server = start_stub(args.stub_port, tokens=args.stub_tokens, ms_per_token=args.stub_ms_per_token)
+    os.environ["OLLAMA_URL"] = url
+    # app.py usa rutas relativas a storage/
+    app_dir = os.path.join(work, "app")
+    os.makedirs(os.path.join(app_dir, "storage", "images"), exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(app_dir)
+    try:
+        import httpx
+        import app as chat_app
+        from modules.pipeline import IngestPipeline
+
+        files = generate_corpus(os.path.join(work, "chat_corpus"), args.chat_docs, args.pages, images_per_doc=0)
+        IngestPipeline(chat_app.vs, chat_app.processing_status, workers=args.workers).run(files)
+        chat_app.processing_status["done"] = True
+        rng = np.random.default_rng(args.seed)
+        from bench.corpus import PARTS
+        questions = [
+            f"What torque or clearance applies to the {rng.choice(PARTS)}? (#{i})"
+            for i in range(args.chat_requests)
+        ]
+
+        # Servidor real: con ASGITransport la respuesta llega entera y no se puede medir el TTFT
+        app_url, app_server = serve_in_thread(chat_app.app, args.app_port)
+
+        async def run():
+            sem = asyncio.Semaphore(args.chat_concurrency)
+            limits = httpx.Limits(max_connections=args.chat_concurrency)
+            async with httpx.AsyncClient(base_url=app_url, timeout=None, limits=limits) as client:
+                async def one(q, stream):
+                    async with sem:
+                        t0 = time.perf_counter()
+                        if not stream:
+                            r = await client.post("/chat", json={"question": q})
+                            return 1000 * (time.perf_counter() - t0), None, r.status_code
+                        ttft = None
+                        async with client.stream("POST", "/chat/stream", json={"question": q}) as r:
+                            async for line in r.aiter_lines():
+                                if ttft is None and line.startswith("event: token"):
+                                    ttft = 1000 * (time.perf_counter() - t0)
+                        return 1000 * (time.perf_counter() - t0), ttft, r.status_code
+
+                out = {}
+                for stream in (False, True):
+                    # Sufijo distinto por modo para no medir la caché de respuestas
+                    qs = [q + (" stream" if stream else "") for q in questions]
+                    t0 = time.perf_counter()
+                    res = await asyncio.gather(*[one(q, stream) for q in qs])
+                    wall = time.perf_counter() - t0
+                    out["stream" if stream else "chat"] = {
+                        "latency": percentiles([r[0] for r in res]),
+                        "ttft": percentiles([r[1] for r in res if r[1] is not None]) if stream else None,
+                        "status_codes": {str(c): sum(1 for r in res if r[2] == c) for c in {r[2] for r in res}},
+                        "throughput_rps": len(res) / wall,
+                    }
+                return out
+
+        try:
+            result = asyncio.run(run())
+        finally:
+            app_server.should_exit = True
+        result.update({
+            "requests": args.chat_requests,
+            "concurrency": args.chat_concurrency,
+            "chunks_indexed": int(chat_app.vs.ntotal),
+            "stub": {"tokens": args.stub_tokens, "ms_per_token": args.stub_ms_per_token},
+        })
+        return result
+    finally:
+        os.chdir(cwd)
+        server.should_exit = True
+
+
+SUITES = {"ingest": bench_ingest, "retrieval": bench_retrieval, "chat": bench_chat}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de ingesta, recuperación y chat")
+    parser.add_argument("--suite", default="ingest,retrieval,chat")
+    parser.add_argument("--out", default=os.path.join(ROOT, "bench", "results"))
+    parser.add_argument("--seed", type=int, default=0)
+    # ingesta
+    parser.add_argument("--docs", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=2)
+    parser.add_argument("--images-per-doc", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--batch-size", type=int, default=256)
+    # recuperación
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--index-modes", default="flat,hnsw,ivf,sq8,pq")
+    # Pérdida de recall@k aceptada respecto del flat exacto
+    parser.add_argument("--recall-tolerance", type=float, default=0.01)
+    # chat
+    parser.add_argument("--chat-docs", type=int, default=20)
+    parser.add_argument("--chat-requests", type=int, default=100)
+    parser.add_argument("--chat-concurrency", type=int, default=8)
+    parser.add_argument("--app-port", type=int, default=18000)
+    parser.add_argument("--stub-port", type=int, default=11435)
+    parser.add_argument("--stub-tokens", type=int, default=40)
+    parser.add_argument("--stub-ms-per-token", type=float, default=5.0)
+    args = parser.parse_args()
+    args.index_modes = [m for m in args.index_modes.split(",") if m]
+
+    work = tempfile.mkdtemp(prefix="gm-bench-")
+    # Imágenes extraídas y caché de OCR del benchmark fuera de storage/
+    os.environ.setdefault("IMAGES_DIR", os.path.join(work, "images"))
+    os.environ.setdefault("OCR_CACHE_PATH", os.path.join(work, "ocr_cache_pipeline.sqlite"))
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        }
+    }
+    try:
+        for name in args.suite.split(","):
+            print(f"== {name}")
+            report[name] = SUITES[name](args, work)
+            print(json.dumps(report[name], indent=2))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.join(args.out, f"bench-{time.strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json")
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Resultados en {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import json
+import time
+import asyncio
+import argparse
+import threading
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+# Imita /api/generate de Ollama: latencia de "prompt processing" proporcional al prompt
+# y luego tokens a un ritmo fijo, con o sin streaming
+stub = FastAPI(title="Ollama stub")
+CONFIG = {"prefill_ms_per_kchar": 20.0, "ttft_ms": 50.0, "tokens": 40, "ms_per_token": 5.0}
+
+
+@stub.post("/api/generate")
+async def generate(request: Request):
+    body = await request.json()
+    prompt = body.get("prompt", "")
+    prefill = (CONFIG["ttft_ms"] + CONFIG["prefill_ms_per_kchar"] * len(prompt) / 1000) / 1000
+    tokens = [f" tok{i}" for i in range(CONFIG["tokens"])]
+    # Mismos campos finales que Ollama (conteo de tokens del prompt estimado en 4 caracteres)
+    final = {
+        "done": True,
+        "prompt_eval_count": len(prompt) // 4,
+        "prompt_eval_duration": int(prefill * 1e9),
+        "eval_count": len(tokens),
+        "eval_duration": int(CONFIG["ms_per_token"] * len(tokens) * 1e6),
+    }
+
+    if not body.get("stream", True):
+        await asyncio.sleep(prefill + CONFIG["ms_per_token"] * len(tokens) / 1000)
+        return {"model": body.get("model"), "response": "".join(tokens), **final}
+
+    async def lines():
+        await asyncio.sleep(prefill)
+        for t in tokens:
+            yield json.dumps({"model": body.get("model"), "response": t, "done": False}) + "\n"
+            await asyncio.sleep(CONFIG["ms_per_token"] / 1000)
+        yield json.dumps({"model": body.get("model"), "response": "", **final}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def serve_in_thread(app, port):
+    """Sirve una app ASGI con uvicorn en un hilo y devuelve (URL base, servidor)."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", server
+
+
+def start_stub(port=11435, **config):
+    """Levanta el stub en un hilo y devuelve su URL base."""
+    CONFIG.update(config)
+    return serve_in_thread(stub, port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub local de Ollama para benchmarks")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--tokens", type=int, default=CONFIG["tokens"])
+    parser.add_argument("--ms-per-token", type=float, default=CONFIG["ms_per_token"])
+    parser.add_argument("--ttft-ms", type=float, default=CONFIG["ttft_ms"])
+    args = parser.parse_args()
+    CONFIG.update(tokens=args.tokens, ms_per_token=args.ms_per_token, ttft_ms=args.ttft_ms)
+    uvicorn.run(stub, host="127.0.0.1", port=args.port)
@@ -1,5 +1,190 @@
 
+import os
+import json
+import asyncio
+import contextlib
 import requests
+import httpx
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "mistral")
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", 32))
+# Sin límite de lectura total: en streaming lo que importa es el tiempo entre tokens
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", 120))
+# Generaciones simultáneas hacia Ollama, cuántas pueden esperar turno y por cuánto tiempo
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 2))
+LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING", 32))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))
+
+_async_client = None
+
+
+def get_async_client():
+    # Un solo cliente HTTP asíncrono por proceso, con conexiones keep-alive reutilizables
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            base_url=OLLAMA_URL,
+            timeout=httpx.Timeout(10.0, read=OLLAMA_READ_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_MAX_CONNECTIONS,
+            ),
+        )
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def build_prompt(context, question):
+    return f"""
+Contesta en el idioma detectado del usuario.
+Contexto extraído de documentos:
+{context}
+
+Pregunta del usuario:
+{question}
+
+Responde de forma precisa y solo usa la información relevante del contexto. Si no hay información suficiente, di que no la encontraste.
+"""
+
+
+def generate_payload(prompt, stream, model=OLLAMA_MODEL):
+    return {
+        "model": model,
+        "prompt": prompt,
+        "stream": stream,
+        "options": {"temperature": 0.2},
+    }
+
+
+def usage(data):
+    # Conteos y tiempos que Ollama reporta al terminar una generación
+    return {
+        "prompt_tokens": data.get("prompt_eval_count"),
+        "completion_tokens": data.get("eval_count"),
+        "prompt_eval_ms": data["prompt_eval_duration"] / 1e6 if data.get("prompt_eval_duration") else None,
+        "eval_ms": data["eval_duration"] / 1e6 if data.get("eval_duration") else None,
+    }
+
+
+async def stream_generate(prompt, model=OLLAMA_MODEL, stats=None):
+    """Itera los tokens de /api/generate a medida que Ollama los produce.
+
+    Si quien consume deja de iterar (p. ej. el cliente se desconectó), al cerrar el
+    generador se cierra la conexión y Ollama cancela la generación. Si se pasa stats
+    (dict), al final se llena con usage().
+    """
+    client = get_async_client()
+    async with client.stream("POST", "/api/generate", json=generate_payload(prompt, True, model)) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            data = json.loads(line)
+            if data.get("error"):
+                raise RuntimeError(data["error"])
+            if data.get("response"):
+                yield data["response"]
+            if data.get("done"):
+                if stats is not None:
+                    stats.update(usage(data))
+                break
+
+
+async def generate(prompt, model=OLLAMA_MODEL, stats=None):
+    client = get_async_client()
+    r = await client.post("/api/generate", json=generate_payload(prompt, False, model))
+    r.raise_for_status()
+    data = r.json()
+    if stats is not None:
+        stats.update(usage(data))
+    return data.get("response", "").strip()
+
+
+class LLMBusy(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class LLMLimiter:
+    """Semáforo para las generaciones con una fila acotada.
+
+    429 si la fila ya está llena al llegar, 503 si se espera más de timeout segundos.
+    """
+
+    def __init__(self, concurrency=LLM_CONCURRENCY, max_waiting=LLM_MAX_WAITING, timeout=LLM_QUEUE_TIMEOUT):
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self._sem = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+
+    def check(self):
+        if self._sem.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise LLMBusy(429, "Demasiadas preguntas en espera, intenta de nuevo en unos segundos.")
+
+    async def acquire(self):
+        self.check()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise LLMBusy(503, "El modelo está ocupado, intenta de nuevo en unos segundos.")
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+        self._sem.release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+class Coalescer:
+    """Une las peticiones idénticas en vuelo: una sola tarea atiende a todos los que esperan."""
+
+    def __init__(self):
+        self._inflight = {}
+        self.coalesced = 0
+
+    async def run(self, key, factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield: si un cliente cancela, la generación sigue para los demás
+        return await asyncio.shield(task)
+
 
 def ask_llm(context, question, model="mistral"):
     prompt = f"""
@@ -0,0 +1,117 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", 4096))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 4096))
+# 0 desactiva la caché de respuestas finales
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1024))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 600))
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class TTLCache(LRUCache):
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = super().get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            with self._lock:
+                self._data.pop(key, None)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return value
+
+    def put(self, key, value):
+        super().put(key, (time.monotonic() + self.ttl, value))
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+
+def embedding_key(embedding, top_k):
+    return hashlib.sha1(embedding.tobytes()).hexdigest(), top_k
+
+
+class QueryCache:
+    """Cachés de /chat: pregunta -> embedding, embedding+top_k -> ids, y respuestas con TTL.
+
+    Las dos últimas dependen del contenido del índice y se vacían cuando cambia
+    vs.version (add/reset). La de embeddings solo depende del modelo, así que se conserva.
+    """
+
+    def __init__(self, vs):
+        self.vs = vs
+        self.embeddings = LRUCache(QUERY_EMBED_CACHE_SIZE)
+        self.results = LRUCache(RETRIEVAL_CACHE_SIZE)
+        self.answers = TTLCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL) if ANSWER_CACHE_SIZE > 0 and ANSWER_CACHE_TTL > 0 else None
+        self.version = vs.version
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def check_version(self):
+        with self._lock:
+            if self.vs.version != self.version:
+                self.results.clear()
+                if self.answers is not None:
+                    self.answers.clear()
+                self.version = self.vs.version
+                self.invalidations += 1
+
+    def get_answer(self, key):
+        return self.answers.get(key) if self.answers is not None else None
+
+    def put_answer(self, key, value):
+        if self.answers is not None:
+            self.answers.put(key, value)
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "invalidations": self.invalidations,
+            "embeddings": self.embeddings.stats(),
+            "results": self.results.stats(),
+            "answers": self.answers.stats() if self.answers is not None else None,
+        }
@@ -0,0 +1,502 @@
+import os
+import re
+import json
+import heapq
+import shutil
+import hashlib
+import time
+import threading
+import contextlib
+import contextvars
+from itertools import islice
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from modules.manifest import Manifest
+from modules.vector_store import VectorStore, fuse, HYBRID_CANDIDATES, INDEX_TYPES
+
+# Colecciones con nombre, cada una con uno o más shards (un VectorStore por shard).
+# La colección "default" es el storage/ de siempre, con un solo shard.
+DEFAULT_COLLECTION = "default"
+# Tope de memoria de los índices cargados; se descargan las colecciones menos usadas (LRU)
+COLLECTIONS_MEMORY_MB = float(os.getenv("COLLECTIONS_MEMORY_MB", 4096))
+COLLECTIONS_FANOUT_WORKERS = int(os.getenv("COLLECTIONS_FANOUT_WORKERS", 8))
+# Una colección descargada se cierra (SQLite, mmap) pasado este tiempo: las consultas que ya
+# la tenían terminan antes. Si se vuelve a pedir mientras tanto, se reusa sin reabrirla
+COLLECTIONS_CLOSE_DELAY_S = float(os.getenv("COLLECTIONS_CLOSE_DELAY_S", 30))
+NAME_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_fanout_pool = ThreadPoolExecutor(max_workers=COLLECTIONS_FANOUT_WORKERS)
+
+
+class CollectionError(ValueError):
+    pass
+
+
+def _merge(lists, depth):
+    # k-way merge de listas (puntaje, id) ya ordenadas de mejor a peor
+    return list(islice(heapq.merge(*lists, key=lambda x: -x[0]), depth))
+
+
+def fanout_search(members, query_embeddings, top_k, nprobe=None, ef_search=None, query_texts=None,
+                  langs=None, lang_mode=None):
+    """Busca en todos los shards en paralelo y mezcla por puntaje antes de fusionar.
+
+    members: [(VectorStore, fn id local -> id global)]. Los puntajes densos son comparables
+    entre shards (mismo espacio de embeddings); los BM25 se aproximan (idf por shard).
+    """
+    hybrid = query_texts is not None and any(store.hybrid for store, _ in members)
+    depth = top_k * HYBRID_CANDIDATES if hybrid else top_k
+    arr = np.array(query_embeddings, dtype="float32")
+    if len(members) == 1:
+        parts = [members[0][0].search_raw(arr, depth, nprobe, ef_search, query_texts, langs, lang_mode)]
+    else:
+        futures = [
+            _fanout_pool.submit(
+                contextvars.copy_context().run, store.search_raw,
+                arr, depth, nprobe, ef_search, query_texts, langs, lang_mode,
+            )
+            for store, _ in members
+        ]
+        parts = [f.result() for f in futures]
+    results = []
+    for q in range(len(arr)):
+        dense, lexical = [], []
+        for (_, gid), raw in zip(members, parts):
+            d, lx = raw[q]
+            dense.append([(s, gid(i)) for s, i in d])
+            if lx is not None:
+                lexical.append([(s, gid(i)) for s, i in lx])
+        results.append(fuse(_merge(dense, depth), _merge(lexical, depth) if hybrid else None, top_k))
+    return results
+
+
+class Collection:
+    """Una colección repartida en shards. Un documento completo va siempre al mismo shard
+    y los ids globales intercalan shards: id = id_local * n_shards + shard."""
+
+    def __init__(self, name, dim, shard_roots, index_type=None, manifest_path=None, read_only=False):
+        self.name = name
+        self.dim = dim
+        self.shards = [
+            VectorStore(dim=dim, root=r, index_type=index_type, read_only=read_only) for r in shard_roots
+        ]
+        self.manifest = Manifest(manifest_path)
+        self.hybrid = any(s.hybrid for s in self.shards)
+
+    def _gid(self, shard):
+        n = len(self.shards)
+        return lambda i: i * n + shard
+
+    def _split(self, ids):
+        # id global -> {shard: [ids locales]}
+        n = len(self.shards)
+        by_shard = {}
+        for i in ids:
+            by_shard.setdefault(int(i) % n, []).append(int(i) // n)
+        return by_shard
+
+    def members(self):
+        return [(s, self._gid(k)) for k, s in enumerate(self.shards)]
+
+    def _route(self, chunk):
+        key = chunk.get("hash") or chunk.get("source") or ""
+        return int(hashlib.md5(key.encode()).hexdigest(), 16) % len(self.shards)
+
+    def add(self, embeddings, chunks):
+        if len(self.shards) == 1:
+            return self.shards[0].add(embeddings, chunks)
+        groups = {}
+        for row, chunk in enumerate(chunks):
+            groups.setdefault(self._route(chunk), []).append(row)
+        arr = np.asarray(embeddings, dtype="float32")
+        for shard, rows in groups.items():
+            self.shards[shard].add(arr[rows], [chunks[r] for r in rows])
+
+    def remove_document(self, source=None, h=None):
+        # Por hash se sabe el shard; por nombre de origen se busca en todos
+        if h is not None and source is None:
+            return self.shards[self._route({"hash": h})].remove_document(h=h)
+        return sum(s.remove_document(source=source, h=h) for s in self.shards)
+
+    def replace_document(self, embeddings, chunks, source=None, h=None):
+        if len(self.shards) == 1:
+            return self.shards[0].replace_document(embeddings, chunks, source=source, h=h)
+        # Con todos los shards bloqueados (siempre en el mismo orden) ninguna búsqueda ve
+        # las dos versiones ni un documento a medio reemplazar
+        with contextlib.ExitStack() as stack:
+            for s in self.shards:
+                stack.enter_context(s._lock)
+            removed = self.remove_document(source=source, h=h)
+            self.add(embeddings, chunks)
+        return removed
+
+    def search_ids_batch(self, query_embeddings, top_k=5, nprobe=None, ef_search=None, query_texts=None,
+                         langs=None, lang_mode=None):
+        return fanout_search(
+            self.members(), query_embeddings, top_k, nprobe, ef_search, query_texts, langs, lang_mode,
+        )
+
+    def search_ids(self, query_embedding, top_k=5, nprobe=None, ef_search=None, query_text=None,
+                   lang=None, lang_mode=None):
+        query_texts = None if query_text is None else [query_text]
+        return self.search_ids_batch(
+            [query_embedding], top_k, nprobe, ef_search, query_texts, [lang], lang_mode,
+        )[0]
+
+    def get_chunk_map(self, ids):
+        n = len(self.shards)
+        found = {}
+        for shard, local in self._split(ids).items():
+            for i, c in self.shards[shard].get_chunk_map(local).items():
+                found[i * n + shard] = c
+        return found
+
+    def get_chunks(self, ids):
+        found = self.get_chunk_map(ids)
+        return [found[int(i)] for i in ids if int(i) in found]
+
+    def get_vectors(self, ids):
+        n = len(self.shards)
+        found = {}
+        for shard, local in self._split(ids).items():
+            vecs = self.shards[shard].get_vectors(local)
+            if vecs is None:
+                return None
+            found.update({i * n + shard: v for i, v in vecs.items()})
+        return found
+
+    def search(self, query_embedding, top_k=5, nprobe=None, ef_search=None, query_text=None,
+               lang=None, lang_mode=None):
+        return self.get_chunks(
+            self.search_ids(query_embedding, top_k, nprobe, ef_search, query_text, lang, lang_mode)
+        )
+
+    def hashes(self):
+        return set().union(*(s.hashes() for s in self.shards))
+
+    def refresh(self, force=False):
+        return any([s.refresh(force) for s in self.shards])
+
+    @property
+    def version(self):
+        return sum(s.version for s in self.shards)
+
+    @property
+    def ntotal(self):
+        return sum(s.ntotal for s in self.shards)
+
+    def memory_bytes(self):
+        return sum(s.memory_bytes() for s in self.shards)
+
+    def busy(self):
+        return any(s.busy() for s in self.shards)
+
+    def has_knowledge(self):
+        return any(s.has_knowledge() for s in self.shards)
+
+    def compact(self, wait=True):
+        for s in self.shards:
+            s.compact(wait=wait)
+
+    def wait_compaction(self):
+        for s in self.shards:
+            s.wait_compaction()
+
+    def reset(self):
+        for s in self.shards:
+            s.reset()
+        self.manifest.reset()
+
+    def close(self):
+        self.manifest.save(force=False)
+        for s in self.shards:
+            s.close()
+
+
+class CollectionGroup:
+    """Consulta sobre varias colecciones a la vez; los ids son (colección, id global)."""
+
+    def __init__(self, collections):
+        self.collections = dict(collections)
+        self.hybrid = any(c.hybrid for c in self.collections.values())
+
+    def members(self):
+        return [
+            (store, lambda i, name=name, gid=gid: (name, gid(i)))
+            for name, c in self.collections.items()
+            for store, gid in c.members()
+        ]
+
+    def search_ids_batch(self, query_embeddings, top_k=5, nprobe=None, ef_search=None, query_texts=None,
+                         langs=None, lang_mode=None):
+        return fanout_search(
+            self.members(), query_embeddings, top_k, nprobe, ef_search, query_texts, langs, lang_mode,
+        )
+
+    def search_ids(self, query_embedding, top_k=5, nprobe=None, ef_search=None, query_text=None,
+                   lang=None, lang_mode=None):
+        query_texts = None if query_text is None else [query_text]
+        return self.search_ids_batch(
+            [query_embedding], top_k, nprobe, ef_search, query_texts, [lang], lang_mode,
+        )[0]
+
+    def _split(self, ids):
+        by_name = {}
+        for name, i in ids:
+            by_name.setdefault(name, []).append(i)
+        return by_name
+
+    def get_chunk_map(self, ids):
+        found = {}
+        for name, local in self._split(ids).items():
+            found.update({(name, i): c for i, c in self.collections[name].get_chunk_map(local).items()})
+        return found
+
+    def get_vectors(self, ids):
+        found = {}
+        for name, local in self._split(ids).items():
+            vecs = self.collections[name].get_vectors(local)
+            if vecs is None:
+                return None
+            found.update({(name, i): v for i, v in vecs.items()})
+        return found
+
+    def has_knowledge(self):
+        return any(c.has_knowledge() for c in self.collections.values())
+
+
+class Catalog:
+    """Colecciones en disco, cargadas al primer uso y descargadas por LRU bajo un tope de memoria.
+
+    Una colección fijada (pin) no se descarga: los jobs de ingesta la fijan mientras escriben.
+    La colección por defecto queda fijada siempre.
+    """
+
+    def __init__(self, dim, root="storage", memory_mb=None, read_only=False):
+        self.dim = dim
+        self.root = root
+        # Workers de consulta: las colecciones se abren de solo lectura y las crea/borra el escritor
+        self.read_only = read_only
+        self.dir = os.path.join(root, "collections")
+        self.memory_cap = (memory_mb or COLLECTIONS_MEMORY_MB) * 2**20
+        self._lock = threading.RLock()
+        self._loaded = OrderedDict()
+        # Descargadas pendientes de cerrar: nombre -> (colección, momento de la descarga)
+        self._retired = {}
+        # Una carga por nombre a la vez, sin frenar las consultas a las colecciones ya cargadas
+        self._load_locks = {}
+        self._pins = Counter({DEFAULT_COLLECTION: 1})
+        # Cambia al cargar, descargar, crear o borrar: junto con las versiones invalida las cachés
+        self.generation = 0
+        self.evictions = 0
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _config(self, name):
+        with open(os.path.join(self._path(name), "collection.json"), "r") as f:
+            return json.load(f)
+
+    def exists(self, name):
+        return name == DEFAULT_COLLECTION or os.path.exists(os.path.join(self._path(name), "collection.json"))
+
+    def names(self):
+        names = [DEFAULT_COLLECTION]
+        if os.path.isdir(self.dir):
+            names += sorted(n for n in os.listdir(self.dir) if n != DEFAULT_COLLECTION and self.exists(n))
+        return names
+
+    def _check_writable(self):
+        if self.read_only:
+            raise CollectionError("Catálogo de solo lectura")
+
+    def create(self, name, shards=1, index_type=None):
+        self._check_writable()
+        if not NAME_RE.match(name or ""):
+            raise CollectionError(f"Nombre de colección inválido: {name!r}")
+        if self.exists(name):
+            raise CollectionError(f"La colección {name!r} ya existe")
+        if shards < 1:
+            raise CollectionError("shards debe ser >= 1")
+        if index_type is not None and index_type not in INDEX_TYPES:
+            raise CollectionError(f"index_type inválido: {index_type!r} ({', '.join(INDEX_TYPES)})")
+        path = self._path(name)
+        os.makedirs(path, exist_ok=True)
+        config = {"shards": shards, "index_type": index_type}
+        tmp = os.path.join(path, "collection.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(config, f)
+        os.replace(tmp, os.path.join(path, "collection.json"))
+        return self.get(name)
+
+    def _load(self, name):
+        if name == DEFAULT_COLLECTION:
+            # Diseño de siempre: storage/index*.faiss, storage/chunks.sqlite, storage/manifest.json
+            return Collection(
+                name, self.dim, [self.root], manifest_path=os.path.join(self.root, "manifest.json"),
+                read_only=self.read_only,
+            )
+        config = self._config(name)
+        path = self._path(name)
+        roots = [os.path.join(path, f"shard-{k}") for k in range(config["shards"])]
+        return Collection(
+            name, self.dim, roots, index_type=config.get("index_type"),
+            manifest_path=os.path.join(path, "manifest.json"), read_only=self.read_only,
+        )
+
+    def get(self, name=DEFAULT_COLLECTION):
+        with self._lock:
+            coll = self._loaded.get(name) or self._revive(name)
+            if coll is not None:
+                self._loaded.move_to_end(name)
+                self._evict(keep=name)
+                return coll
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        # Lectura del índice y apertura del SQLite fuera del lock global
+        with load_lock:
+            with self._lock:
+                coll = self._loaded.get(name) or self._revive(name)
+            if coll is None:
+                if not self.exists(name):
+                    raise KeyError(name)
+                coll = self._load(name)
+                with self._lock:
+                    self._loaded[name] = coll
+                    self.generation += 1
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+            self._evict(keep=name)
+        return coll
+
+    def _revive(self, name):
+        # Descargada pero todavía abierta: vuelve sin reabrir los archivos
+        if name not in self._retired or not self.exists(name):
+            return None
+        entry = self._retired.pop(name)
+        self._loaded[name] = entry[0]
+        self.generation += 1
+        return entry[0]
+
+    def view(self, names=None):
+        # Una colección o un grupo de varias (ids compuestos)
+        names = list(dict.fromkeys(names or [DEFAULT_COLLECTION]))
+        if len(names) == 1:
+            return self.get(names[0])
+        return CollectionGroup([(n, self.get(n)) for n in names])
+
+    def memory_bytes(self):
+        with self._lock:
+            return sum(c.memory_bytes() for c in self._loaded.values())
+
+    def _evict(self, keep=None):
+        total = self.memory_bytes()
+        for name in list(self._loaded):
+            if total <= self.memory_cap:
+                break
+            coll = self._loaded[name]
+            if name == keep or self._pins[name] > 0 or coll.busy():
+                continue
+            total -= coll.memory_bytes()
+            # Las consultas en curso conservan su referencia: se cierra más tarde
+            del self._loaded[name]
+            coll.manifest.save(force=False)
+            self._retired[name] = (coll, time.monotonic())
+            self.generation += 1
+            self.evictions += 1
+        self._close_retired()
+
+    def _retire_dropped(self, name, coll):
+        # Colección borrada: las consultas en curso la siguen usando (los archivos abiertos
+        # sobreviven al borrado) y se cierra con la misma demora. La clave no es el nombre
+        # para que una colección nueva con ese nombre no la reviva
+        self._retired[(name, id(coll))] = (coll, time.monotonic())
+
+    def _close_retired(self, delay=None):
+        delay = COLLECTIONS_CLOSE_DELAY_S if delay is None else delay
+        now = time.monotonic()
+        for name, (coll, since) in list(self._retired.items()):
+            if now - since >= delay and not coll.busy():
+                del self._retired[name]
+                coll.close()
+
+    @contextlib.contextmanager
+    def pin(self, name):
+        with self._lock:
+            self._pins[name] += 1
+        try:
+            yield self.get(name)
+        finally:
+            with self._lock:
+                self._pins[name] -= 1
+                self._evict()
+
+    def refresh(self):
+        # Solo lectura: toma los índices que publicó el escritor y olvida las colecciones borradas
+        if not self.read_only:
+            return
+        with self._lock:
+            loaded = list(self._loaded.items())
+        for name, coll in loaded:
+            if not self.exists(name):
+                with self._lock:
+                    if self._loaded.pop(name, None) is not None:
+                        self._retire_dropped(name, coll)
+                    self.generation += 1
+            else:
+                coll.refresh()
+        with self._lock:
+            self._close_retired()
+
+    def reset(self, name=DEFAULT_COLLECTION):
+        self._check_writable()
+        self.get(name).reset()
+        with self._lock:
+            self.generation += 1
+
+    def drop(self, name):
+        # La colección por defecto no se borra, solo se vacía
+        if name == DEFAULT_COLLECTION:
+            return self.reset(name)
+        self._check_writable()
+        with self._lock:
+            if not self.exists(name):
+                raise KeyError(name)
+            if self._pins[name] > 0:
+                raise CollectionError(f"La colección {name!r} está en uso")
+            colls = [self._loaded.pop(name, None), self._retired.pop(name, (None,))[0]]
+            for coll in filter(None, colls):
+                # Termina de escribir antes de borrar: al cerrarse más tarde no vuelve a escribir
+                coll.wait_compaction()
+                coll.manifest.save(force=False)
+                self._retire_dropped(name, coll)
+            shutil.rmtree(self._path(name), ignore_errors=True)
+            self.generation += 1
+            self._close_retired()
+
+    @property
+    def version(self):
+        with self._lock:
+            return self.generation, sum(c.version for c in self._loaded.values())
+
+    def stats(self):
+        with self._lock:
+            loaded = dict(self._loaded)
+            pins = dict(self._pins)
+        out = []
+        for name in self.names():
+            coll = loaded.get(name)
+            entry = {"name": name, "loaded": coll is not None, "pinned": pins.get(name, 0) > 0}
+            if coll is not None:
+                entry.update({
+                    "shards": len(coll.shards),
+                    "vectors": coll.ntotal,
+                    "memory_mb": round(coll.memory_bytes() / 2**20, 2),
+                })
+            elif name != DEFAULT_COLLECTION:
+                entry["shards"] = self._config(name)["shards"]
+            out.append(entry)
+        return out
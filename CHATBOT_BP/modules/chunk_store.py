@@ -0,0 +1,280 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import Counter
+
+from modules.lexical import FTS_TOKENIZER, index_text, match_query, max_df, query_terms
+from modules.utils import detect_language
+
+# Columnas propias; cualquier otra llave del chunk se guarda en "extra" como JSON
+COLUMNS = ("source", "page", "is_image", "image_path", "hash", "text", "lang")
+
+
+class ChunkStore:
+    """Metadatos y texto de los chunks en SQLite, indexados por el id de FAISS."""
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL permite lectores concurrentes (otros workers) mientras se escribe
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                source TEXT,
+                page INTEGER,
+                is_image INTEGER,
+                image_path TEXT,
+                hash TEXT,
+                text TEXT,
+                extra TEXT,
+                lang TEXT
+            )"""
+        )
+        # Idioma de cada chunk, detectado al ingerir (stores anteriores: se agrega la columna)
+        has_lang = any(r[1] == "lang" for r in self.conn.execute("PRAGMA table_info(chunks)"))
+        if not has_lang and not read_only:
+            self.conn.execute("ALTER TABLE chunks ADD COLUMN lang TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_hash ON chunks(hash)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks(source)")
+        # Índice invertido BM25 sin contenido propio (el texto ya está en chunks)
+        has_fts = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'"
+        ).fetchone() is not None
+        self.conn.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(terms, content='', tokenize=\"{FTS_TOKENIZER}\")"
+        )
+        # Frecuencia de documento por término (fts5vocab la calcula recorriendo cada lista de postings)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunk_terms (term TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID")
+        # Ids de chunks borrados cuyo vector sigue en el índice FAISS hasta la próxima reconstrucción
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tombstones (id INTEGER PRIMARY KEY)")
+        self.conn.commit()
+        if read_only:
+            # Workers de consulta: el escritor es el único que modifica la base
+            self.conn.execute("PRAGMA query_only=ON")
+        else:
+            if not has_fts and not self.is_empty():
+                self._backfill_fts()
+            if not has_lang and not self.is_empty():
+                self._backfill_lang()
+
+    def _backfill_fts(self, batch=10000):
+        # Stores creados antes del índice léxico: se indexa lo que ya existe
+        print("Construyendo índice léxico (BM25) de los chunks existentes...")
+        last = -1
+        while True:
+            with self._lock, self.conn:
+                rows = self.conn.execute(
+                    "SELECT id, text FROM chunks WHERE id > ? ORDER BY id LIMIT ?", (last, batch)
+                ).fetchall()
+                if not rows:
+                    break
+                self._fts_insert(rows)
+            last = rows[-1][0]
+
+    def _backfill_lang(self, batch=10000):
+        print("Detectando el idioma de los chunks existentes...")
+        last = -1
+        while True:
+            with self._lock, self.conn:
+                rows = self.conn.execute(
+                    "SELECT id, text FROM chunks WHERE id > ? ORDER BY id LIMIT ?", (last, batch)
+                ).fetchall()
+                if not rows:
+                    break
+                self.conn.executemany(
+                    "UPDATE chunks SET lang = ? WHERE id = ?",
+                    [(detect_language(t, default=None), i) for i, t in rows],
+                )
+            last = rows[-1][0]
+
+    def _update_df(self, indexed, sign):
+        df = Counter(t for terms in indexed for t in set(terms.split()))
+        self.conn.executemany(
+            "INSERT INTO chunk_terms VALUES (?, ?) ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+            [(t, sign * n) for t, n in df.items()],
+        )
+
+    def _fts_insert(self, rows):
+        # rows: (id, texto)
+        indexed = [index_text(t) for _, t in rows]
+        self.conn.executemany(
+            "INSERT INTO chunks_fts (rowid, terms) VALUES (?, ?)",
+            [(i, terms) for (i, _), terms in zip(rows, indexed)],
+        )
+        self._update_df(indexed, 1)
+
+    def _fts_delete(self, where, params):
+        # Un índice sin contenido solo permite borrar pasando los mismos términos que se insertaron
+        rows = self.conn.execute(f"SELECT id, text FROM chunks WHERE {where}", params).fetchall()
+        if not rows:
+            return
+        indexed = [index_text(t) for _, t in rows]
+        self.conn.executemany(
+            "INSERT INTO chunks_fts (chunks_fts, rowid, terms) VALUES ('delete', ?, ?)",
+            [(i, terms) for (i, _), terms in zip(rows, indexed)],
+        )
+        self._update_df(indexed, -1)
+
+    @staticmethod
+    def _to_row(id_, chunk):
+        extra = {k: v for k, v in chunk.items() if k not in COLUMNS}
+        return (
+            id_,
+            chunk.get("source"),
+            chunk.get("page"),
+            int(bool(chunk.get("is_image"))),
+            chunk.get("image_path") or None,
+            chunk.get("hash"),
+            chunk.get("text"),
+            json.dumps(extra) if extra else None,
+            # La ingesta ya lo trae; si no, se detecta acá
+            chunk["lang"] if "lang" in chunk else detect_language(chunk.get("text"), default=None),
+        )
+
+    @staticmethod
+    def _from_row(row):
+        # Un lector puede abrir la base antes de que el escritor agregue la columna lang
+        _, source, page, is_image, image_path, h, text, extra, lang = tuple(row) + (None,) * (9 - len(row))
+        chunk = {
+            "text": text,
+            "source": source,
+            "page": page,
+            "is_image": bool(is_image),
+            "image_path": image_path or False,
+            "hash": h,
+            "lang": lang,
+        }
+        if extra:
+            chunk.update(json.loads(extra))
+        return chunk
+
+    def add(self, start_id, chunks):
+        rows = [self._to_row(start_id + i, c) for i, c in enumerate(chunks)]
+        if not rows:
+            return
+        with self._lock, self.conn:
+            self._fts_delete("id BETWEEN ? AND ?", (start_id, start_id + len(rows) - 1))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self._fts_insert([(r[0], r[6]) for r in rows])
+
+    def search_text(self, text, top_k=5, scores=False, lang=None):
+        # BM25 sobre el índice invertido; descarta los términos demasiado frecuentes.
+        # Con scores=True devuelve (id, puntaje BM25) con el mayor primero. Con lang, solo
+        # chunks de ese idioma o sin idioma detectado
+        terms = query_terms(text)
+        if not terms:
+            return []
+        marks = ",".join("?" * len(terms))
+        with self._lock:
+            n = self.conn.execute("SELECT MAX(id) + 1 FROM chunks").fetchone()[0] or 0
+            df = dict(self.conn.execute(
+                f"SELECT term, df FROM chunk_terms WHERE term IN ({marks})", terms
+            ).fetchall())
+            limit = max_df(n)
+            terms = [t for t in terms if 0 < df.get(t, 0) <= limit]
+            if not terms:
+                return []
+            if lang is None:
+                rows = self.conn.execute(
+                    "SELECT rowid, rank FROM chunks_fts WHERE chunks_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (match_query(terms), top_k),
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT f.rowid, f.rank FROM chunks_fts f JOIN chunks c ON c.id = f.rowid "
+                    "WHERE chunks_fts MATCH ? AND (c.lang = ? OR c.lang IS NULL) ORDER BY f.rank LIMIT ?",
+                    (match_query(terms), lang, top_k),
+                ).fetchall()
+        if scores:
+            # rank de FTS5 es el BM25 negado
+            return [(r[0], -r[1]) for r in rows]
+        return [r[0] for r in rows]
+
+    def get_map(self, ids):
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        marks = ",".join("?" * len(ids))
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM chunks WHERE id IN ({marks})", ids
+            ).fetchall()
+        return {r[0]: self._from_row(r) for r in rows}
+
+    def get_many(self, ids):
+        # Devuelve los chunks en el mismo orden que ids (solo los top-k de una búsqueda)
+        by_id = self.get_map(ids)
+        return [by_id[int(i)] for i in ids if int(i) in by_id]
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def is_empty(self):
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def hashes(self):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT hash FROM chunks WHERE hash IS NOT NULL"
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def truncate(self, n):
+        # Borra filas sin vector en el índice (p. ej. un corte antes de escribir el WAL)
+        with self._lock, self.conn:
+            self._fts_delete("id >= ?", (n,))
+            self.conn.execute("DELETE FROM chunks WHERE id >= ?", (n,))
+            self.conn.execute("DELETE FROM tombstones WHERE id >= ?", (n,))
+
+    def remove(self, source=None, h=None):
+        # Borra los chunks de un documento y deja sus ids como tombstones, en la misma transacción
+        column, value = ("source", source) if source is not None else ("hash", h)
+        with self._lock, self.conn:
+            ids = [r[0] for r in self.conn.execute(f"SELECT id FROM chunks WHERE {column} = ?", (value,))]
+            if ids:
+                self._fts_delete(f"{column} = ?", (value,))
+                self.conn.execute(f"DELETE FROM chunks WHERE {column} = ?", (value,))
+                self.conn.executemany("INSERT OR IGNORE INTO tombstones VALUES (?)", [(i,) for i in ids])
+        return ids
+
+    def langs(self, start, end):
+        # (id, idioma) de los chunks con id en [start, end) que tienen idioma
+        with self._lock:
+            try:
+                return self.conn.execute(
+                    "SELECT id, lang FROM chunks WHERE id >= ? AND id < ? AND lang IS NOT NULL", (start, end)
+                ).fetchall()
+            except sqlite3.OperationalError:
+                # Base sin la columna todavía (lector abierto antes que el escritor)
+                return []
+
+    def tombstones(self):
+        with self._lock:
+            return {r[0] for r in self.conn.execute("SELECT id FROM tombstones")}
+
+    def clear_tombstones(self, ids):
+        # Ids que ya no están en el índice persistido
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM tombstones WHERE id = ?", [(int(i),) for i in ids])
+
+    def data_version(self):
+        # Cambia cuando otra conexión (el escritor) hace commit
+        with self._lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def reset(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('delete-all')")
+            self.conn.execute("DELETE FROM chunk_terms")
+            self.conn.execute("DELETE FROM tombstones")
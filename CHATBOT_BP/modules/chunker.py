@@ -0,0 +1,47 @@
+import os
+
+# Tamaño de chunk en tokens del modelo de embeddings (0 = el máximo que acepta el modelo)
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 0))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 32))
+
+
+def split_chunks(chunks, tokenizer, max_tokens, overlap=CHUNK_OVERLAP):
+    """Parte cada chunk en ventanas de max_tokens tokens con solapamiento.
+
+    Tokeniza todos los textos en una sola llamada (tokenizer rápido, por lotes) y usa los
+    offsets de caracteres para cortar el texto original. Devuelve una lista por chunk de
+    entrada; cada pedazo conserva source/page y agrega "chunk", "char_start" y "tokens".
+    """
+    if not chunks:
+        return []
+    overlap = min(overlap, max_tokens // 2)
+    step = max_tokens - overlap
+    enc = tokenizer(
+        [c["text"] for c in chunks],
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+        verbose=False,
+    )
+    out = []
+    for chunk, offsets in zip(chunks, enc["offset_mapping"]):
+        n = len(offsets)
+        if n <= max_tokens:
+            out.append([{**chunk, "chunk": 0, "char_start": 0, "tokens": n}])
+            continue
+        pieces = []
+        for k, start in enumerate(range(0, n, step)):
+            window = offsets[start:start + max_tokens]
+            begin, end = window[0][0], window[-1][1]
+            pieces.append({
+                **chunk,
+                "text": chunk["text"][begin:end],
+                "chunk": k,
+                "char_start": begin,
+                "tokens": len(window),
+            })
+            if start + max_tokens >= n:
+                break
+        out.append(pieces)
+    return out
@@ -0,0 +1,124 @@
+import os
+import re
+
+import numpy as np
+
+from modules import models
+
+# Armado del contexto para el LLM: se traen más candidatos de los que se usan, se quitan
+# casi-duplicados, se diversifica con MMR y se llena un presupuesto de tokens
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 20))
+CONTEXT_MAX_CHUNKS = int(os.getenv("CONTEXT_MAX_CHUNKS", 5))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+# Casi-duplicado: coseno entre embeddings o fracción de shingles del más corto contenida en el otro
+CONTEXT_DEDUP_COSINE = float(os.getenv("CONTEXT_DEDUP_COSINE", 0.95))
+CONTEXT_DEDUP_CONTAINMENT = float(os.getenv("CONTEXT_DEDUP_CONTAINMENT", 0.8))
+# 1 = solo relevancia, 0 = solo diversidad
+MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
+# Tokenizer de HF del modelo de generación (p. ej. "mistralai/Mistral-7B-Instruct-v0.2");
+# sin él se estima con CHARS_PER_TOKEN
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "")
+CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", 4.0))
+
+WORD_RE = re.compile(r"\w+")
+
+
+def get_tokenizer():
+    def load():
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(CONTEXT_TOKENIZER)
+    return models.get(("context_tokenizer", CONTEXT_TOKENIZER), load)
+
+
+def count_tokens(text):
+    if CONTEXT_TOKENIZER:
+        return len(get_tokenizer()(text, add_special_tokens=False)["input_ids"])
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def truncate_tokens(text, n):
+    if CONTEXT_TOKENIZER:
+        tok = get_tokenizer()
+        return tok.decode(tok(text, add_special_tokens=False)["input_ids"][:n])
+    return text[:int(n * CHARS_PER_TOKEN)]
+
+
+def shingles(text, n=3):
+    words = WORD_RE.findall(text.lower())
+    if len(words) < n:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def containment(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def assemble(ids, chunks, vectors, render, budget=None, max_chunks=None):
+    """Elige qué chunks van al prompt.
+
+    ids: candidatos en orden de relevancia; chunks: {id: chunk}; vectors: {id: embedding}
+    o None; render(chunk) -> texto tal como entra al prompt.
+    Devuelve ([(id, chunk) elegidos], duplicados descartados, estadísticas).
+    """
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    max_chunks = max_chunks or CONTEXT_MAX_CHUNKS
+    ids = [i for i in ids if i in chunks]
+    sh = {i: shingles(chunks[i]["text"]) for i in ids}
+    vecs = None
+    if vectors is not None and all(i in vectors for i in ids) and ids:
+        vecs = np.array([vectors[i] for i in ids], dtype="float32")
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12
+        sim = vecs @ vecs.T
+    else:
+        sim = np.array([[containment(sh[a], sh[b]) for b in ids] for a in ids])
+
+    # 1) Casi-duplicados: se conserva el de mejor posición
+    kept, dups = [], []
+    for pos, i in enumerate(ids):
+        dup = any(
+            (vecs is not None and sim[pos, k] >= CONTEXT_DEDUP_COSINE)
+            or containment(sh[i], sh[ids[k]]) >= CONTEXT_DEDUP_CONTAINMENT
+            for k in kept
+        )
+        (dups if dup else kept).append(pos)
+
+    # 2) MMR: relevancia por posición en el ranking (ya fusionado), diversidad por similitud
+    n = len(ids)
+    relevance = {pos: 1.0 - pos / max(1, n) for pos in kept}
+    order, left = [], list(kept)
+    while left:
+        best = max(
+            left,
+            key=lambda p: MMR_LAMBDA * relevance[p]
+            - (1 - MMR_LAMBDA) * max((sim[p, q] for q in order), default=0.0),
+        )
+        order.append(best)
+        left.remove(best)
+
+    # 3) Presupuesto de tokens: entra lo que cabe, en orden MMR
+    selected, used = [], 0
+    for pos in order:
+        if len(selected) >= max_chunks:
+            break
+        chunk = chunks[ids[pos]]
+        tokens = count_tokens(render(chunk))
+        if used + tokens > budget:
+            if selected:
+                continue
+            # Ni el primero cabe completo: se recorta
+            chunk = {**chunk, "text": truncate_tokens(chunk["text"], budget)}
+            tokens = count_tokens(render(chunk))
+        selected.append((ids[pos], chunk))
+        used += tokens
+
+    stats = {
+        "candidates": n,
+        "duplicates": len(dups),
+        "chunks": len(selected),
+        "context_tokens": used,
+        "token_budget": budget,
+    }
+    return selected, [chunks[ids[p]] for p in dups], stats
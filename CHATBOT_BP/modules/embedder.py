@@ -1,8 +1,26 @@
-from sentence_transformers import SentenceTransformer
+import sys
+from modules.models import get_embedding_model, EMBED_DIM
 
-model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
+def get_model():
+    return get_embedding_model()
 
-def embed_texts(texts):
+def embed_texts(texts, batch_size=32):
     if isinstance(texts[0], dict):
         texts = [c['text'] for c in texts]
-    return model.encode(texts, show_progress_bar=False, normalize_embeddings=True)
+    return get_model().encode(texts, batch_size=batch_size, show_progress_bar=False, normalize_embeddings=True)
+
+def embedding_dim():
+    return EMBED_DIM or get_model().get_sentence_embedding_dimension()
+
+def get_tokenizer():
+    return get_model().tokenizer
+
+def max_tokens():
+    # max_seq_length incluye los tokens especiales [CLS] y [SEP]
+    return get_model().max_seq_length - 2
+
+if __name__ == "__main__":
+    # python -m modules.embedder --export-int8 : exporta el modelo cuantizado y muestra la comparación
+    from modules.models import export_quantized_model
+    if "--export-int8" in sys.argv:
+        print(export_quantized_model())
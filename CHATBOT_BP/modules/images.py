@@ -0,0 +1,222 @@
+import io
+import os
+import re
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from modules import metrics
+
+# Imágenes extraídas guardadas por contenido: images/<sha1>.<ext>. La misma imagen en varios
+# documentos (logos, encabezados) queda una sola vez en disco. Al ingerir se genera además una
+# miniatura acotada (images/thumbs/<sha1>_<tamaño>.jpg), que es la que muestra el chat
+IMAGES_DIR = os.getenv("IMAGES_DIR") or os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'storage', 'images'))
+THUMBS_DIR = os.path.join(IMAGES_DIR, "thumbs")
+THUMB_SIZE = int(os.getenv("IMAGES_THUMB_SIZE", 320))
+THUMB_QUALITY = int(os.getenv("IMAGES_THUMB_QUALITY", 80))
+# Un nombre por hash nunca cambia de contenido: el navegador lo guarda sin revalidar.
+# Los nombres del formato anterior (archivo_pN_imgM.ext) se reescriben al reingerir: se revalidan
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+META_CACHE_SIZE = int(os.getenv("IMAGES_META_CACHE", 4096))
+
+HASH_NAME_RE = re.compile(r"^[0-9a-f]{40}(_\d+)?$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+os.makedirs(THUMBS_DIR, exist_ok=True)
+
+metrics.describe("image_requests_total", "Peticiones de imágenes por código de respuesta")
+
+
+def image_hash(img_bytes):
+    return hashlib.sha1(img_bytes).hexdigest()
+
+
+def _write_once(path, data):
+    # Varios procesos de ingesta pueden guardar la misma imagen a la vez: temporal propio + rename
+    if os.path.exists(path):
+        return
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _thumbnail(h, img_bytes):
+    # Miniatura JPEG de THUMB_SIZE de lado como máximo; None si la original ya es chica
+    # o si PIL no sabe leer el formato (el chat muestra entonces la original)
+    name = f"{h}_{THUMB_SIZE}.jpg"
+    path = os.path.join(THUMBS_DIR, name)
+    if os.path.exists(path):
+        return name
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            if max(img.size) <= THUMB_SIZE:
+                return None
+            img.draft("RGB", (THUMB_SIZE, THUMB_SIZE))
+            img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                bg = Image.new("RGB", img.size, "white")
+                bg.paste(img, mask=img.getchannel("A"))
+                img = bg
+            else:
+                img = img.convert("RGB")
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=THUMB_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"WARNING: no se pudo generar la miniatura de {h}: {e}")
+        return None
+    _write_once(path, buf.getvalue())
+    return name
+
+
+def save(img_bytes, ext="png", h=None):
+    """Guarda una imagen por su hash (si no estaba) y su miniatura.
+
+    Devuelve (ruta, ruta de la miniatura o None), relativas como 'images/...'.
+    """
+    h = h or image_hash(img_bytes)
+    name = f"{h}.{ext}"
+    with metrics.span("image_store"):
+        _write_once(os.path.join(IMAGES_DIR, name), img_bytes)
+        thumb = _thumbnail(h, img_bytes)
+    return f"images/{name}", (f"images/thumbs/{thumb}" if thumb else None)
+
+
+# ------------------------------------------------------------------ servicio HTTP
+
+_lock = threading.Lock()
+_meta = OrderedDict()
+
+
+def _resolve(name):
+    # "<archivo>" o "thumbs/<archivo>", nunca fuera de IMAGES_DIR
+    parts = name.split("/")
+    if len(parts) > 2 or (len(parts) == 2 and parts[0] != "thumbs"):
+        return None
+    if any(p in ("", ".", "..") or "\\" in p for p in parts):
+        return None
+    return os.path.join(IMAGES_DIR, *parts)
+
+
+def _stat(name):
+    # Metadatos de la imagen (tamaño, ETag, tipo); los de nombres por hash no se vuelven a leer
+    with _lock:
+        meta = _meta.get(name)
+        if meta is not None:
+            _meta.move_to_end(name)
+    if meta is not None and meta["immutable"]:
+        return meta
+    path = _resolve(name)
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    if meta is not None and meta["key"] == key:
+        return meta
+    stem = os.path.basename(path).split(".")[0]
+    immutable = bool(HASH_NAME_RE.match(stem))
+    if immutable:
+        etag = f'"{stem}"'
+    else:
+        # Formato anterior: ETag fuerte por contenido, calculado una vez por versión del archivo
+        with open(path, "rb") as f:
+            etag = f'"{hashlib.sha1(f.read()).hexdigest()}"'
+    meta = {
+        "path": path,
+        "size": st.st_size,
+        "etag": etag,
+        "type": mimetypes.guess_type(path)[0] or "application/octet-stream",
+        "immutable": immutable,
+        "key": key,
+    }
+    with _lock:
+        _meta[name] = meta
+        while len(_meta) > META_CACHE_SIZE:
+            _meta.popitem(last=False)
+    return meta
+
+
+def _forget(name):
+    with _lock:
+        _meta.pop(name, None)
+
+
+def _etag_match(header, etag):
+    # If-None-Match: lista de ETags o "*"; comparación débil (se ignora el prefijo W/)
+    if header.strip() == "*":
+        return True
+    return any(t.strip().removeprefix("W/") == etag for t in header.split(","))
+
+
+def _range(header, size):
+    # (inicio, fin) inclusivo de un único rango; None = se responde entero; "invalid" = 416.
+    # Varios rangos a la vez no se soportan: se ignora el header (la RFC lo permite)
+    m = RANGE_RE.match(header.strip().replace(" ", ""))
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if not m.group(1):
+        n = int(m.group(2))
+        if n == 0:
+            return "invalid"
+        return max(0, size - n), size - 1
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) else size - 1
+    if start >= size or end < start:
+        return "invalid"
+    return start, min(end, size - 1)
+
+
+def respond(name, headers, head=False):
+    """Respuesta para GET/HEAD /images/<name>: (status, headers, cuerpo), o None si no existe.
+
+    ETag fuerte, Cache-Control, If-None-Match (304) y Range/If-Range (206/416).
+    """
+    meta = _stat(name)
+    if meta is None:
+        metrics.inc("image_requests_total", code="404")
+        return None
+    out = {
+        "ETag": meta["etag"],
+        "Cache-Control": CACHE_IMMUTABLE if meta["immutable"] else CACHE_REVALIDATE,
+        "Accept-Ranges": "bytes",
+    }
+    inm = headers.get("if-none-match")
+    if inm and _etag_match(inm, meta["etag"]):
+        metrics.inc("image_requests_total", code="304")
+        return 304, out, b""
+    size = meta["size"]
+    status, start, end = 200, 0, size - 1
+    rng = headers.get("range")
+    if_range = headers.get("if-range")
+    if rng and (not if_range or if_range.strip() == meta["etag"]):
+        r = _range(rng, size)
+        if r == "invalid":
+            metrics.inc("image_requests_total", code="416")
+            return 416, {**out, "Content-Range": f"bytes */{size}"}, b""
+        if r is not None:
+            status, (start, end) = 206, r
+            out["Content-Range"] = f"bytes {start}-{end}/{size}"
+    length = end - start + 1 if size else 0
+    out["Content-Type"] = meta["type"]
+    out["Content-Length"] = str(length)
+    body = b""
+    if not head and length:
+        try:
+            with open(meta["path"], "rb") as f:
+                f.seek(start)
+                body = f.read(length)
+        except OSError:
+            # Se borró (reset) después de cachear sus metadatos
+            _forget(name)
+            metrics.inc("image_requests_total", code="404")
+            return None
+    metrics.inc("image_requests_total", code=str(status))
+    return status, out, body
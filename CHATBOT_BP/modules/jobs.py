@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+from modules.pipeline import IngestPipeline
+from modules.catalog import DEFAULT_COLLECTION
+
+JOBS_PATH = os.path.join("storage", "jobs.sqlite")
+# Estados de un job: queued -> running -> done | cancelled | failed
+ACTIVE = ("queued", "running")
+
+
+class JobStore:
+    """Jobs de ingesta y el estado de cada uno de sus archivos, en SQLite."""
+
+    def __init__(self, path=JOBS_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                path TEXT,
+                status TEXT,
+                params TEXT,
+                created REAL,
+                started REAL,
+                finished REAL,
+                resumes INTEGER DEFAULT 0,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id TEXT,
+                path TEXT,
+                state TEXT,
+                error TEXT,
+                PRIMARY KEY (job_id, path)
+            );"""
+        )
+        self.conn.commit()
+
+    def create(self, path, files, params):
+        job_id = uuid.uuid4().hex[:12]
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs (id, path, status, params, created) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, path, json.dumps(params), time.time()),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO job_files VALUES (?, ?, 'pending', NULL)",
+                [(job_id, f) for f in files],
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            counts = dict(self.conn.execute(
+                "SELECT state, COUNT(*) FROM job_files WHERE job_id = ? GROUP BY state", (job_id,)
+            ).fetchall())
+            errors = self.conn.execute(
+                "SELECT path, error FROM job_files WHERE job_id = ? AND state = 'error' LIMIT 50", (job_id,)
+            ).fetchall()
+        job = dict(row)
+        job["params"] = json.loads(job["params"] or "{}")
+        total = sum(counts.values())
+        finished = total - counts.get("pending", 0)
+        job.update({
+            "files": counts,
+            "total": total,
+            "progress": int(100 * finished / total) if total else 100,
+            "errors": [dict(e) for e in errors],
+        })
+        return job
+
+    def list(self, limit=50):
+        with self._lock:
+            ids = [r[0] for r in self.conn.execute(
+                "SELECT id FROM jobs ORDER BY created DESC LIMIT ?", (limit,)
+            ).fetchall()]
+        return [self.get(i) for i in ids]
+
+    def active_ids(self):
+        with self._lock:
+            return [r[0] for r in self.conn.execute(
+                f"SELECT id FROM jobs WHERE status IN ({','.join('?' * len(ACTIVE))}) ORDER BY created", ACTIVE
+            ).fetchall()]
+
+    def pending_files(self, job_id):
+        with self._lock:
+            return [r[0] for r in self.conn.execute(
+                "SELECT path FROM job_files WHERE job_id = ? AND state = 'pending' ORDER BY rowid", (job_id,)
+            ).fetchall()]
+
+    def set_status(self, job_id, status, error=None):
+        column = {"running": "started"}.get(status, "finished")
+        with self._lock, self.conn:
+            self.conn.execute(
+                f"UPDATE jobs SET status = ?, error = ?, {column} = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def mark_resumed(self, job_id):
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE jobs SET resumes = resumes + 1 WHERE id = ?", (job_id,))
+
+    def file_done(self, job_id, path, state, error=None):
+        # Cada archivo terminado es un checkpoint: al reanudar no se vuelve a procesar
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE job_files SET state = ?, error = ? WHERE job_id = ? AND path = ?",
+                (state, error, job_id, path),
+            )
+
+
+class JobManager:
+    """Cola persistente de jobs de ingesta con un solo escritor del índice.
+
+    Un único hilo ejecuta los jobs en orden; cualquier otra mutación del índice (reset)
+    pasa por write_lock. Los jobs que quedaron activos al reiniciar se reanudan con
+    los archivos que les faltaban. Con publish=True cada job termina compactando, para que
+    los workers de solo lectura vean el índice nuevo.
+    """
+
+    def __init__(self, catalog, status, store=None, publish=False):
+        self.catalog = catalog
+        # status es el de la colección por defecto (el de /progress y el que habilita /chat);
+        # las demás colecciones tienen el suyo
+        self.status = status
+        self.statuses = {}
+        self.publish = publish
+        self.store = store or JobStore()
+        self.write_lock = threading.RLock()
+        self.current = None
+        self._cancel = {}
+        self._queue = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        resumed = self.store.active_ids()
+        with self._cond:
+            for job_id in resumed:
+                self.store.mark_resumed(job_id)
+                self._enqueue(job_id)
+        if resumed:
+            print(f"Reanudando {len(resumed)} job(s) de ingesta sin terminar")
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def status_for(self, collection=DEFAULT_COLLECTION):
+        if collection == DEFAULT_COLLECTION:
+            return self.status
+        return self.statuses.setdefault(collection, {"progress": 0, "total": 0, "done": False, "message": ""})
+
+    def _enqueue(self, job_id):
+        self._cancel[job_id] = threading.Event()
+        self._queue.append(job_id)
+        self._cond.notify()
+
+    def submit(self, path, files, params=None):
+        job_id = self.store.create(path, files, params or {})
+        with self._cond:
+            self._enqueue(job_id)
+        return job_id
+
+    def get(self, job_id):
+        job = self.store.get(job_id)
+        if job is not None:
+            job["position"] = self._queue.index(job_id) + 1 if job_id in self._queue else None
+        return job
+
+    def list(self):
+        return self.store.list()
+
+    def active(self):
+        return self.current is not None or bool(self._queue)
+
+    def cancel(self, job_id):
+        job = self.store.get(job_id)
+        if job is None or job["status"] not in ACTIVE:
+            return job
+        with self._cond:
+            event = self._cancel.get(job_id)
+            if event is not None:
+                event.set()
+            if job_id in self._queue:
+                # Todavía no empezó: se cancela sin pasar por el worker
+                self._queue.remove(job_id)
+                self._cancel.pop(job_id, None)
+                self.store.set_status(job_id, "cancelled")
+        return self.store.get(job_id)
+
+    def cancel_all(self, collection=None):
+        for job_id in self.store.active_ids():
+            if collection is None or self.store.get(job_id)["params"].get("collection", DEFAULT_COLLECTION) == collection:
+                self.cancel(job_id)
+
+    def reset(self, fn, collection=None):
+        # Cancela los jobs (de una colección o todos), espera a que el job en curso suelte
+        # el índice y ejecuta fn (p. ej. vs.reset)
+        self.cancel_all(collection)
+        with self.write_lock:
+            return fn()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job_id = self._queue.pop(0)
+                self.current = job_id
+            try:
+                with self.write_lock:
+                    self._run(job_id)
+            except Exception as e:
+                print(f"ERROR en job de ingesta {job_id}: {e}")
+                self.store.set_status(job_id, "failed", error=repr(e))
+            finally:
+                self.current = None
+                self._cancel.pop(job_id, None)
+
+    def _run(self, job_id):
+        cancel = self._cancel[job_id]
+        if cancel.is_set():
+            self.store.set_status(job_id, "cancelled")
+            return
+        job = self.store.get(job_id)
+        # La colección queda fijada en memoria mientras se escribe en ella
+        name = job["params"].get("collection", DEFAULT_COLLECTION)
+        with self.catalog.pin(name) as coll:
+            self._ingest(job_id, job, coll, cancel, self.status_for(name))
+
+    def _ingest(self, job_id, job, vs, cancel, status):
+        files = self.store.pending_files(job_id)
+        self.store.set_status(job_id, "running")
+        status.update({
+            "progress": 0, "total": len(files), "done": False, "message": "Processing...", "job_id": job_id,
+        })
+        self._remove_deleted(vs, job["params"].get("deleted", ()))
+        # Contenido ya presente en el índice: lo registrado en el manifest más los hashes
+        # de los chunks guardados (cubre un corte entre el add() y el checkpoint del archivo)
+        known = vs.manifest.hashes() | vs.hashes()
+
+        def on_file_done(path, result, error):
+            self.store.file_done(job_id, path, "error" if error else "done", error)
+
+        params = job["params"]
+        pipeline = IngestPipeline(
+            vs, status, manifest=vs.manifest,
+            workers=params.get("workers"), batch_size=params.get("batch_size"),
+            chunk_tokens=params.get("chunk_tokens"), chunk_overlap=params.get("chunk_overlap"),
+            cancel=cancel, on_file_done=on_file_done,
+        )
+        pipeline.run(files, known=known)
+        if self.publish:
+            vs.compact()
+        if cancel.is_set():
+            self.store.set_status(job_id, "cancelled")
+            status["message"] = "Cancelled"
+        else:
+            self.store.set_status(job_id, "done")
+
+    def _remove_deleted(self, vs, paths):
+        # Archivos que ya no existen: se olvidan y se borran sus chunks del índice
+        for path in paths:
+            entry = vs.manifest.get(path)
+            if entry is None:
+                continue
+            vs.manifest.forget(path)
+            if entry["hash"] not in vs.manifest.hashes():
+                vs.remove_document(h=entry["hash"])
+        vs.manifest.save(force=False)
@@ -0,0 +1,72 @@
+import os
+import re
+
+# Búsqueda léxica (BM25) sobre un índice invertido FTS5 en el mismo SQLite de los chunks.
+# El texto se tokeniza aquí y FTS5 recibe los términos ya separados por espacios, para
+# conservar identificadores como "M10", "90-105Nm", "10.9" o "IndexFlatL2".
+LEXICAL_MAX_TERMS = int(os.getenv("LEXICAL_MAX_TERMS", 16))
+# Términos presentes en más de esta fracción de los chunks no aportan y hacen lenta la consulta
+LEXICAL_MAX_DF = float(os.getenv("LEXICAL_MAX_DF", 0.05))
+# ...siempre que además aparezcan en más de LEXICAL_DF_FLOOR chunks (corpus chicos no se filtran)
+LEXICAL_DF_FLOOR = int(os.getenv("LEXICAL_DF_FLOOR", 1000))
+
+TOKEN_RE = re.compile(r"\w+(?:[.\-/]\w+)*")
+SPLIT_RE = re.compile(r"[.\-/_]")
+ALNUM_RE = re.compile(r"\d+|[^\W\d]+")
+FTS_TOKENIZER = "unicode61 remove_diacritics 2 tokenchars '.-/_'"
+
+STOPWORDS = set("""
+a an and are as at be by for from how in is it of on or that the this to was what when where which
+who why with does do can should must i you we my our your their there these those into than then
+el la los las un una unos unas y o de del al en con por para que qué es son se su sus lo como cómo
+cual cuál cuales cuáles cuando cuándo donde dónde debe deben hay mi mis tu tus me le les ya no si
+""".split())
+
+
+def tokenize(text):
+    # Cada identificador compuesto se indexa completo y también por partes:
+    # "90-105Nm" -> "90-105nm", "90", "105nm", "105", "nm"
+    terms = []
+    for m in TOKEN_RE.finditer((text or "").lower()):
+        tok = m.group()
+        parts = [p for p in SPLIT_RE.split(tok) if p]
+        if len(parts) > 1:
+            terms.append(tok)
+        for p in parts:
+            if p in STOPWORDS:
+                continue
+            terms.append(p)
+            pieces = ALNUM_RE.findall(p)
+            if len(pieces) > 1:
+                terms.extend(pieces)
+    return terms
+
+
+def index_text(text):
+    return " ".join(tokenize(text))
+
+
+def match_query(terms):
+    # OR de términos entre comillas: ningún término se interpreta como sintaxis de FTS5
+    return " OR ".join(f'"{t}"' for t in terms)
+
+
+def max_df(n_chunks):
+    return max(LEXICAL_DF_FLOOR, LEXICAL_MAX_DF * n_chunks)
+
+
+def query_terms(text):
+    seen = []
+    for t in tokenize(text):
+        if t not in seen:
+            seen.append(t)
+    return seen[:LEXICAL_MAX_TERMS]
+
+
+def rrf(rankings, weights, k=60):
+    """Reciprocal rank fusion: suma de weight / (k + posición) de cada lista de ids."""
+    scores = {}
+    for ids, w in zip(rankings, weights):
+        for rank, i in enumerate(ids):
+            scores[i] = scores.get(i, 0.0) + w / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
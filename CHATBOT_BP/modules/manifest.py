@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import threading
+
+MANIFEST_PATH = os.path.join("storage", "manifest.json")
+HASH_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    # MD5 por bloques: no carga el archivo completo en memoria
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Registro persistente de archivos ya ingeridos: ruta -> tamaño, mtime y hash del contenido."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._dirty = 0
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("files", {})
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    def get(self, path):
+        return self.entries.get(self._key(path))
+
+    def hashes(self):
+        with self._lock:
+            return {e["hash"] for e in self.entries.values()}
+
+    def find(self, name):
+        # Rutas registradas con ese nombre de archivo (los chunks guardan solo el nombre)
+        with self._lock:
+            return [k for k in self.entries if os.path.basename(k) == name]
+
+    def scan(self, files, root=None):
+        # Clasifica los archivos solo con stat(); no lee contenido
+        result = {"new": [], "modified": [], "unchanged": [], "deleted": []}
+        seen = set()
+        for f in files:
+            key = self._key(f)
+            seen.add(key)
+            entry = self.entries.get(key)
+            if entry is None:
+                result["new"].append(f)
+                continue
+            try:
+                st = os.stat(f)
+            except OSError:
+                result["deleted"].append(f)
+                continue
+            if st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]:
+                result["unchanged"].append(f)
+            else:
+                result["modified"].append(f)
+        # Los borrados se siguen reportando mientras sigan en el manifest
+        prefix = os.path.join(self._key(root), "") if root else None
+        for key in self.entries:
+            if key not in seen and (prefix is None or key.startswith(prefix)):
+                result["deleted"].append(key)
+        return result
+
+    def record(self, path, st, h):
+        with self._lock:
+            self.entries[self._key(path)] = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "hash": h,
+            }
+            self._dirty += 1
+
+    def forget(self, path):
+        with self._lock:
+            if self.entries.pop(self._key(path), None) is not None:
+                self._dirty += 1
+
+    def save(self, force=True):
+        with self._lock:
+            if not self._dirty and not force:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"files": self.entries}, f)
+            os.replace(tmp, self.path)
+            self._dirty = 0
+
+    def maybe_save(self, every=50):
+        if self._dirty >= every:
+            self.save(force=False)
+
+    def reset(self):
+        with self._lock:
+            self.entries = {}
+            self._dirty = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
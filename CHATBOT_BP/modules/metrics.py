@@ -0,0 +1,162 @@
+import time
+import threading
+import contextlib
+import contextvars
+from collections import defaultdict
+
+# Métricas en memoria del proceso, expuestas en formato de texto de Prometheus (/metrics)
+PREFIX = "chatbot_"
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_callbacks = {}
+_help = {}
+
+# Perfil por request (o por archivo en los workers de ingesta): lista de (etapa, segundos)
+_profile = contextvars.ContextVar("profile", default=None)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _fmt_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def observe(name, seconds, **labels):
+    k = _key(labels)
+    with _lock:
+        h = _histograms.setdefault(name, {}).get(k)
+        if h is None:
+            h = _histograms[name][k] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, b in enumerate(BUCKETS):
+            if seconds <= b:
+                h["buckets"][i] += 1
+        h["sum"] += seconds
+        h["count"] += 1
+
+
+def inc(name, value=1, **labels):
+    k = _key(labels)
+    with _lock:
+        series = _counters.setdefault(name, defaultdict(float))
+        series[k] += value
+
+
+def register(name, kind, fn, help_text="", **labels):
+    """Métrica calculada al momento de exponerla (profundidad de colas, tamaño del índice...)."""
+    with _lock:
+        _callbacks.setdefault(name, {"kind": kind, "series": {}})["series"][_key(labels)] = fn
+        if help_text:
+            _help[name] = help_text
+
+
+def describe(name, help_text):
+    _help[name] = help_text
+
+
+def record(stage, seconds, timings=None):
+    observe("stage_seconds", seconds, stage=stage)
+    if timings is None:
+        timings = _profile.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+def counters():
+    with _lock:
+        return {name: dict(series) for name, series in _counters.items()}
+
+
+def counters_since(before):
+    # Incrementos desde una foto anterior, como lista serializable de (nombre, labels, valor)
+    return [
+        (name, k, v - before.get(name, {}).get(k, 0))
+        for name, series in counters().items()
+        for k, v in series.items()
+        if v != before.get(name, {}).get(k, 0)
+    ]
+
+
+def replay(timings, counts=()):
+    # Tiempos y contadores medidos en otro proceso (pool de parseo) que se suman a este
+    for stage, seconds in timings:
+        record(stage, seconds)
+    for name, k, value in counts:
+        inc(name, value, **dict(k))
+
+
+@contextlib.contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def profile(timings=None):
+    """Junta las etapas medidas dentro del bloque (incluye hilos que copian el contexto)."""
+    timings = [] if timings is None else timings
+    token = _profile.set(timings)
+    try:
+        yield timings
+    finally:
+        _profile.reset(token)
+
+
+def summarize(timings):
+    stages = defaultdict(float)
+    for stage, seconds in timings:
+        stages[stage] += 1000 * seconds
+    return {stage: round(ms, 3) for stage, ms in stages.items()}
+
+
+def render():
+    lines = []
+    with _lock:
+        for name, series in sorted(_histograms.items()):
+            full = PREFIX + name
+            lines.append(f"# HELP {full} {_help.get(name, name)}")
+            lines.append(f"# TYPE {full} histogram")
+            for k, h in sorted(series.items()):
+                for b, n in zip(BUCKETS, h["buckets"]):
+                    lines.append(f"{full}_bucket{_fmt_labels(k, [('le', b)])} {n}")
+                lines.append(f"{full}_bucket{_fmt_labels(k, [('le', '+Inf')])} {h['count']}")
+                lines.append(f"{full}_sum{_fmt_labels(k)} {h['sum']}")
+                lines.append(f"{full}_count{_fmt_labels(k)} {h['count']}")
+        for name, series in sorted(_counters.items()):
+            full = PREFIX + name
+            lines.append(f"# HELP {full} {_help.get(name, name)}")
+            lines.append(f"# TYPE {full} counter")
+            for k, v in sorted(series.items()):
+                lines.append(f"{full}{_fmt_labels(k)} {v}")
+        callbacks = {name: (cb["kind"], dict(cb["series"])) for name, cb in _callbacks.items()}
+    for name, (kind, series) in sorted(callbacks.items()):
+        full = PREFIX + name
+        lines.append(f"# HELP {full} {_help.get(name, name)}")
+        lines.append(f"# TYPE {full} {kind}")
+        for k, fn in sorted(series.items()):
+            try:
+                lines.append(f"{full}{_fmt_labels(k)} {float(fn())}")
+            except Exception:
+                continue
+    return "\n".join(lines) + "\n"
+
+
+describe("stage_seconds", "Duración de cada etapa de ingesta y consulta")
+describe("request_seconds", "Duración total de las peticiones de chat")
+describe("chat_requests_total", "Peticiones de chat por endpoint")
+describe("ingest_files_total", "Archivos procesados por la ingesta según resultado")
+describe("ingest_chunks_total", "Chunks agregados al índice")
+describe("ocr_images_total", "Imágenes vistas por el OCR según resultado")
+describe("queue_depth", "Elementos esperando en cada cola")
+describe("llm_prompt_tokens_total", "Tokens de prompt procesados por Ollama")
+describe("llm_completion_tokens_total", "Tokens generados por Ollama")
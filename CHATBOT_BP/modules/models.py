@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import threading
+
+import numpy as np
+
+# Registro de modelos: cada modelo se carga la primera vez que se usa y una sola vez por proceso
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL", "paraphrase-MiniLM-L6-v2")
+# Dimensión de los embeddings sin cargar el modelo (los índices se abren al arrancar). Con otro
+# EMBED_MODEL conviene definir EMBED_DIM; si no, el modelo se carga para averiguarla
+_KNOWN_DIMS = {"paraphrase-MiniLM-L6-v2": 384}
+EMBED_DIM = int(os.getenv("EMBED_DIM", _KNOWN_DIMS.get(EMBED_MODEL_NAME, 0)))
+# "torch" (por defecto), "onnx" o "onnx-int8" (ONNX con cuantización dinámica int8, solo CPU)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+ONNX_QUANTIZATION = os.getenv("EMBED_ONNX_QUANTIZATION", "avx2")  # arm64 | avx2 | avx512 | avx512_vnni
+# Si el modelo cuantizado se aleja de torch más que esto (coseno mínimo), se usa torch
+MIN_QUANTIZED_COSINE = float(os.getenv("EMBED_MIN_QUANTIZED_COSINE", 0.98))
+MODELS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'storage', 'models'))
+OCR_LANGS = ['en', 'es']
+
+_models = {}
+_locks = {}
+_registry_lock = threading.Lock()
+
+
+def get(key, loader):
+    if key in _models:
+        return _models[key]
+    with _registry_lock:
+        lock = _locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _models:
+            _models[key] = loader()
+        return _models[key]
+
+
+def loaded():
+    return list(_models)
+
+
+def get_embedding_model(backend=None):
+    backend = backend or EMBED_BACKEND
+    return get(("embed", EMBED_MODEL_NAME, backend), lambda: _check_dim(_load_embedding_model(backend)))
+
+
+def _check_dim(model):
+    dim = model.get_sentence_embedding_dimension()
+    if EMBED_DIM and dim != EMBED_DIM:
+        raise ValueError(f"EMBED_DIM={EMBED_DIM} no coincide con la dimensión de {EMBED_MODEL_NAME} ({dim})")
+    return model
+
+
+def get_ocr_reader():
+    # EasyOCR puede manejar inglés y español
+    def load():
+        import easyocr
+        return easyocr.Reader(OCR_LANGS, gpu=False)
+    return get(("easyocr", tuple(OCR_LANGS)), load)
+
+
+def _load_embedding_model(backend):
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "torch":
+        return SentenceTransformer(EMBED_MODEL_NAME)
+    if backend == "onnx":
+        return SentenceTransformer(EMBED_MODEL_NAME, backend="onnx")
+    if backend == "onnx-int8":
+        path, file_name = _quantized_model_path()
+        report = _read_report(path)
+        if report is None:
+            report = export_quantized_model()
+        if not report["ok"]:
+            print(f"Modelo int8 descartado (coseno mínimo {report['min_cosine']:.4f}), se usa torch")
+            return get_embedding_model("torch")
+        return SentenceTransformer(path, backend="onnx", model_kwargs={"file_name": file_name})
+    raise ValueError(f"Backend de embeddings desconocido: {backend}")
+
+
+def _quantized_model_path():
+    path = os.path.join(MODELS_DIR, f"{EMBED_MODEL_NAME.replace('/', '__')}-onnx-int8")
+    return path, f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx"
+
+
+def _read_report(path):
+    report_path = os.path.join(path, "accuracy.json")
+    if not os.path.exists(report_path):
+        return None
+    with open(report_path, "r") as f:
+        return json.load(f)
+
+
+def export_quantized_model():
+    # Exporta a ONNX, cuantiza a int8 y mide la diferencia contra el modelo torch
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    path, file_name = _quantized_model_path()
+    onnx_model = SentenceTransformer(EMBED_MODEL_NAME, backend="onnx")
+    onnx_model.save(path)
+    export_dynamic_quantized_onnx_model(onnx_model, ONNX_QUANTIZATION, path)
+    quantized = SentenceTransformer(path, backend="onnx", model_kwargs={"file_name": file_name})
+    report = compare_models(get_embedding_model("torch"), quantized)
+    report["ok"] = report["min_cosine"] >= MIN_QUANTIZED_COSINE
+    with open(os.path.join(path, "accuracy.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+SAMPLE_TEXTS = [
+    "Apply 90-105Nm for M10 bolts in brake caliper mounting.",
+    "Keep brake pedal travel between 25-38mm for optimal ergonomics and fast reaction time.",
+    "Chassis bolts must be minimum grade 10.9.",
+    "Design chassis to achieve at least 18,000 Nm/degree torsional rigidity for sedans.",
+    "All engine-bay connectors IP67 or better.",
+    "Target Cd < 0.28 for sedans, < 0.33 for SUVs.",
+    "Mount height between 600-700mm (center).",
+    "Max 52dBA at full fan.",
+    "Nota adicional: el sistema de frenos requiere validaciones y revisiones constantes.",
+    "¿Cuál es el torque recomendado para los tornillos de la mordaza de freno?",
+    "Mantén la documentación de cambios en el diseño y revisa los puntos de control.",
+    "What is the minimum drain hole size for corrosion prevention?",
+]
+
+
+def compare_models(reference, candidate, texts=SAMPLE_TEXTS):
+    timings = {}
+    embs = {}
+    for name, m in (("reference", reference), ("candidate", candidate)):
+        m.encode(texts[:2], normalize_embeddings=True)  # calentamiento
+        start = time.perf_counter()
+        embs[name] = m.encode(texts, normalize_embeddings=True, show_progress_bar=False)
+        timings[name] = (time.perf_counter() - start) / len(texts)
+    cos = np.sum(embs["reference"] * embs["candidate"], axis=1)
+    # ¿Se conserva el vecino más cercano de cada texto?
+    nn_ref = np.argsort(-(embs["reference"] @ embs["reference"].T), axis=1)[:, 1]
+    nn_cand = np.argsort(-(embs["candidate"] @ embs["candidate"].T), axis=1)[:, 1]
+    return {
+        "mean_cosine": float(cos.mean()),
+        "min_cosine": float(cos.min()),
+        "nn_agreement": float((nn_ref == nn_cand).mean()),
+        "reference_ms_per_text": 1000 * timings["reference"],
+        "candidate_ms_per_text": 1000 * timings["candidate"],
+    }
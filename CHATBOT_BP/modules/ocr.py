@@ -0,0 +1,137 @@
+import io
+import os
+import sqlite3
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+import pytesseract
+
+from modules import metrics
+from modules.images import image_hash
+from modules.models import get_ocr_reader
+
+# Política de motores: "easyocr", "tesseract", "fallback" (EasyOCR y Tesseract solo si
+# EasyOCR no devuelve texto útil) o "both" (comportamiento anterior)
+OCR_ENGINE = os.getenv("OCR_ENGINE", "fallback")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", 2))
+# Imágenes más chicas o con poca entropía (líneas, fondos, íconos) no se procesan
+OCR_MIN_SIDE = int(os.getenv("OCR_MIN_SIDE", 48))
+OCR_MIN_PIXELS = int(os.getenv("OCR_MIN_PIXELS", 64 * 64))
+OCR_MIN_ENTROPY = float(os.getenv("OCR_MIN_ENTROPY", 2.0))
+OCR_FALLBACK_MIN_CHARS = int(os.getenv("OCR_FALLBACK_MIN_CHARS", 8))
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH") or os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'storage', 'ocr_cache.sqlite'))
+
+
+def is_worth_ocr(img):
+    w, h = img.size
+    if min(w, h) < OCR_MIN_SIDE or w * h < OCR_MIN_PIXELS:
+        return False
+    return img.convert("L").entropy() >= OCR_MIN_ENTROPY
+
+
+def _easyocr(img):
+    reader = get_ocr_reader()
+    with metrics.span("ocr_easyocr"):
+        return " ".join(t[1] for t in reader.readtext(np.array(img.convert("RGB"))))
+
+
+def _tesseract(img):
+    with metrics.span("ocr_tesseract"):
+        return pytesseract.image_to_string(img, lang='eng+spa')
+
+
+def ocr_image(img, engine=OCR_ENGINE):
+    if engine == "easyocr":
+        return _easyocr(img).strip()
+    if engine == "tesseract":
+        return _tesseract(img).strip()
+    if engine == "both":
+        return (_easyocr(img) + "\n" + _tesseract(img)).strip()
+    text = _easyocr(img).strip()
+    if len(text) < OCR_FALLBACK_MIN_CHARS:
+        text = (text + "\n" + _tesseract(img)).strip()
+    return text
+
+
+class OcrCache:
+    """Resultados de OCR persistentes por hash de la imagen (y motor)."""
+
+    def __init__(self, path=OCR_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr (hash TEXT, engine TEXT, text TEXT, PRIMARY KEY (hash, engine))"
+        )
+        self.conn.commit()
+
+    def get_many(self, hashes, engine):
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+        marks = ",".join("?" * len(hashes))
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT hash, text FROM ocr WHERE engine = ? AND hash IN ({marks})",
+                [engine] + hashes,
+            ).fetchall()
+        return dict(rows)
+
+    def put_many(self, results, engine):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ocr VALUES (?, ?, ?)",
+                [(h, engine, text) for h, text in results.items()],
+            )
+
+
+class OcrEngine:
+    """Dedup por hash, filtro de tamaño/entropía, caché persistente y pool de workers."""
+
+    def __init__(self, engine=OCR_ENGINE, workers=OCR_WORKERS, cache=None):
+        self.engine = engine
+        self.cache = cache if cache is not None else OcrCache()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _run_one(self, img_bytes):
+        # Decodifica desde memoria, sin pasar por disco
+        img = Image.open(io.BytesIO(img_bytes))
+        img.load()
+        if not is_worth_ocr(img):
+            metrics.inc("ocr_images_total", result="skipped")
+            return ""
+        metrics.inc("ocr_images_total", result="processed")
+        return ocr_image(img, self.engine)
+
+    def run(self, images):
+        """images: {hash: bytes} -> {hash: texto} ("" si se descartó o no tiene texto)."""
+        results = self.cache.get_many(images.keys(), self.engine)
+        metrics.inc("ocr_images_total", len(results), result="cached")
+        todo = [h for h in images if h not in results]
+        # Cada tarea copia el contexto para que sus tiempos lleguen al perfil del archivo
+        futures = {h: self.pool.submit(contextvars.copy_context().run, self._run_one, images[h]) for h in todo}
+        fresh = {}
+        for h, fut in futures.items():
+            try:
+                fresh[h] = fut.result()
+            except Exception as e:
+                metrics.inc("ocr_images_total", result="error")
+                print(f"ERROR en OCR de imagen {h}: {e}")
+        if fresh:
+            self.cache.put_many(fresh, self.engine)
+        results.update(fresh)
+        return results
+
+
+_engine = None
+
+
+def get_ocr_engine():
+    global _engine
+    if _engine is None:
+        _engine = OcrEngine()
+    return _engine
@@ -0,0 +1,272 @@
+import os
+import queue
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from modules import metrics
+from modules.parser import extract_text_and_images
+from modules.utils import detect_language
+from modules.manifest import hash_file
+from modules.chunker import split_chunks, CHUNK_TOKENS, CHUNK_OVERLAP
+
+# Parámetros del pipeline (se pueden sobreescribir por variables de entorno o por request)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 256))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 8))
+
+_DONE = object()
+
+
+def _parse_file(path, h):
+    # Corre dentro del pool de procesos: parseo + OCR de un archivo. Los tiempos por
+    # etapa se devuelven junto al resultado porque las métricas son por proceso
+    before = metrics.counters()
+    with metrics.profile() as timings:
+        try:
+            chunks, err = extract_text_and_images(path), None
+        except Exception as e:
+            chunks, err = [], repr(e)
+    return path, h, chunks, err, (timings, metrics.counters_since(before))
+
+
+class IngestPipeline:
+    """Ingesta en etapas: pool de procesos (parseo/OCR) -> embedding por lotes -> un solo escritor."""
+
+    def __init__(self, vs, status, manifest=None, workers=None, batch_size=None, queue_size=None,
+                 chunk_tokens=None, chunk_overlap=None, cancel=None, on_file_done=None):
+        self.vs = vs
+        self.status = status
+        self.manifest = manifest
+        # cancel: Event que detiene la entrada de archivos nuevos (los que están en vuelo terminan)
+        self.cancel = cancel or threading.Event()
+        # on_file_done(path, result, error): avisa cuando un archivo termina (ingerido o con error)
+        self.on_file_done = on_file_done
+        self.workers = workers or INGEST_WORKERS
+        self.batch_size = batch_size or EMBED_BATCH_SIZE
+        self.chunk_tokens = chunk_tokens or CHUNK_TOKENS
+        self.chunk_overlap = CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+        self.queue_size = queue_size or QUEUE_SIZE
+        # Colas acotadas entre etapas: si una etapa se atrasa, la anterior se bloquea
+        self.parsed_q = queue.Queue(maxsize=self.queue_size)
+        self.embedded_q = queue.Queue(maxsize=self.queue_size)
+        self._lock = threading.Lock()
+        self._finished = 0
+        self._total = 0
+        self._stats = {}
+        self.errors = []
+        # Primera excepción inesperada de una etapa: detiene la entrada y run() la relanza
+        self._error = None
+        # Colas de las que ya se leyó _DONE (no hay que vaciarlas al fallar)
+        self._closed = set()
+        metrics.register("queue_depth", "gauge", self.parsed_q.qsize, queue="ingest_parsed")
+        metrics.register("queue_depth", "gauge", self.embedded_q.qsize, queue="ingest_embedded")
+
+    def _file_done(self, path, h=None, result="ingested", error=None):
+        if error is not None:
+            result = "error"
+            self.errors.append((path, error))
+            self._stats.pop(path, None)
+        elif self.manifest is not None:
+            old = self.manifest.get(path)
+            self.manifest.record(path, self._stats.pop(path), h)
+            self.manifest.maybe_save()
+            if old is not None and old["hash"] != h:
+                # Archivo modificado: la versión nueva ya está en el índice, se borra la anterior
+                self._remove_stale(old["hash"])
+        else:
+            self._stats.pop(path, None)
+        metrics.inc("ingest_files_total", result=result)
+        if self.on_file_done is not None:
+            self.on_file_done(path, result, error)
+        with self._lock:
+            self._finished += 1
+            if self._total:
+                self.status["progress"] = int(100 * self._finished / self._total)
+
+    def _remove_stale(self, h):
+        # Solo si ningún otro archivo del manifest tiene ese mismo contenido
+        if h not in self.manifest.hashes():
+            self.vs.remove_document(h=h)
+
+    def _get(self, q, timeout=None):
+        item = q.get(timeout=timeout)
+        if item is _DONE:
+            self._closed.add(id(q))
+        return item
+
+    def _stage(self, body, in_q, out_q=None):
+        # Si la etapa falla, sigue consumiendo su entrada hasta _DONE (la anterior no queda
+        # bloqueada en la cola acotada) y siempre avisa _DONE a la siguiente
+        try:
+            body()
+        except BaseException as e:
+            print(f"ERROR en el pipeline de ingesta: {e!r}")
+            with self._lock:
+                self._error = self._error or e
+            while id(in_q) not in self._closed:
+                self._get(in_q)
+        finally:
+            if out_q is not None:
+                out_q.put(_DONE)
+
+    def _feed(self, files, known):
+        # Etapa 1: hash + parseo en paralelo, con un máximo de archivos en vuelo
+        max_inflight = self.workers * 2
+        ctx = multiprocessing.get_context("spawn")
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx) as pool:
+                pending = set()
+                for f in files:
+                    if self.cancel.is_set() or self._error is not None:
+                        break
+                    try:
+                        self._stats[f] = os.stat(f)
+                        with metrics.span("hash"):
+                            h = hash_file(f)
+                    except OSError as e:
+                        print(f"ERROR leyendo {f}: {e}")
+                        self._file_done(f, error=repr(e))
+                        continue
+                    # Mismo contenido ya ingerido (solo cambió el mtime, o es un duplicado)
+                    if h in known:
+                        self._file_done(f, h, result="unchanged")
+                        continue
+                    known.add(h)
+                    pending.add(pool.submit(_parse_file, f, h))
+                    if len(pending) >= max_inflight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            self.parsed_q.put(fut.result())
+                for fut in pending:
+                    self.parsed_q.put(fut.result())
+        finally:
+            self.parsed_q.put(_DONE)
+
+    def _embed(self):
+        # Etapa 2: junta chunks de varios archivos, los parte por tokens y hace un solo
+        # model.encode por lote
+        from modules.embedder import embed_texts, get_tokenizer, max_tokens
+
+        tokenizer = get_tokenizer()
+        chunk_tokens = min(self.chunk_tokens or max_tokens(), max_tokens())
+        batch, n_chunks, finished = [], 0, False
+        while not finished:
+            try:
+                item = self._get(self.parsed_q, timeout=0.5 if batch else None)
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                finished = True
+            elif item is not None:
+                path, h, chunks, err, observed = item
+                metrics.replay(*observed)
+                if err:
+                    print(f"ERROR parseando {path}: {err}")
+                    self._file_done(path, error=err)
+                elif not chunks:
+                    # Archivo sin texto: se registra para no volver a parsearlo
+                    self._file_done(path, h)
+                else:
+                    for c in chunks:
+                        c["hash"] = h
+                    batch.append((path, chunks))
+                    n_chunks += len(chunks)
+            # Se vacía el lote si está lleno, si la cola se quedó sin trabajo o al terminar
+            if batch and (n_chunks >= self.batch_size or item is None or finished):
+                # Una sola tokenización para todo el lote; luego se reagrupa por archivo
+                with metrics.span("chunking"):
+                    pieces = split_chunks(
+                        [c for _, chunks in batch for c in chunks],
+                        tokenizer, chunk_tokens, self.chunk_overlap,
+                    )
+                k = 0
+                for j, (path, chunks) in enumerate(batch):
+                    batch[j] = (path, [p for ps in pieces[k:k + len(chunks)] for p in ps])
+                    k += len(chunks)
+                # Idioma por chunk, una sola vez al ingerir: define su partición en la búsqueda
+                with metrics.span("language_detect"):
+                    for _, chunks in batch:
+                        for c in chunks:
+                            c["lang"] = detect_language(c["text"], default=None)
+                texts = [c["text"] for _, chunks in batch for c in chunks]
+                try:
+                    with metrics.span("embed_batch"):
+                        embeddings = embed_texts(texts, batch_size=self.batch_size)
+                except Exception as e:
+                    # No se detiene el pipeline: se descartan los archivos de este lote
+                    print(f"ERROR generando embeddings: {e}")
+                    for path, _ in batch:
+                        self._file_done(path, error=repr(e))
+                else:
+                    start = 0
+                    for path, chunks in batch:
+                        end = start + len(chunks)
+                        self.embedded_q.put((path, chunks, embeddings[start:end]))
+                        start = end
+                batch, n_chunks = [], 0
+
+    def _write(self):
+        # Etapa 3: único escritor del índice. Junta lo que haya en la cola en un solo add()
+        finished = False
+        while not finished:
+            items = [self._get(self.embedded_q)]
+            n_chunks = 0
+            while items[-1] is not _DONE and n_chunks < self.batch_size:
+                n_chunks += len(items[-1][1])
+                try:
+                    items.append(self._get(self.embedded_q, timeout=0))
+                except queue.Empty:
+                    break
+            if items[-1] is _DONE:
+                finished = True
+                items.pop()
+            ok = []
+            for path, chunks, embeddings in items:
+                if embeddings.shape[1] != self.vs.dim or len(embeddings) != len(chunks):
+                    print(f"SKIP: embeddings {embeddings.shape} no coinciden con FAISS ({self.vs.dim}) / chunks ({len(chunks)}) en {path}")
+                    self._file_done(path, error=f"embeddings {embeddings.shape} no coinciden con el índice")
+                else:
+                    ok.append((path, chunks, embeddings))
+            if not ok:
+                continue
+            try:
+                self.vs.add(
+                    np.concatenate([e for _, _, e in ok]),
+                    [c for _, chunks, _ in ok for c in chunks],
+                )
+            except Exception as e:
+                print(f"ERROR guardando en el índice: {e}")
+                for path, _, _ in ok:
+                    self._file_done(path, error=repr(e))
+            else:
+                metrics.inc("ingest_chunks_total", sum(len(chunks) for _, chunks, _ in ok))
+                for path, chunks, _ in ok:
+                    self._file_done(path, chunks[0]["hash"])
+
+    def run(self, files, known=None):
+        self._total = len(files)
+        self._finished = 0
+        known = set(known or ())
+        stages = [
+            threading.Thread(target=self._stage, args=(self._embed, self.parsed_q, self.embedded_q), daemon=True),
+            threading.Thread(target=self._stage, args=(self._write, self.embedded_q), daemon=True),
+        ]
+        for t in stages:
+            t.start()
+        try:
+            self._feed(files, known)
+        finally:
+            for t in stages:
+                t.join()
+            if self.manifest is not None:
+                self.manifest.save()
+        if self._error is not None:
+            # El job queda como failed; lo ya escrito en el índice se conserva
+            self.status["done"] = True
+            self.status["message"] = f"Failed: {self._error!r}"
+            raise self._error
+        self.status["progress"] = 100
+        self.status["done"] = True
+        self.status["message"] = "Ready"
@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import threading
+
+import httpx
+
+# Modo de servicio con varios workers: un solo escritor (ingesta, reset, colecciones) y N
+# workers de consulta de solo lectura que mapean el índice publicado (mmap) y lo recargan
+# cuando cambia. Ejemplo:
+#   SERVE_ROLE=writer uvicorn app:app --port 8001
+#   SERVE_ROLE=reader SERVE_WRITER_URL=http://127.0.0.1:8001 uvicorn app:app --workers 4 --port 8000
+# "all" (por defecto) es el proceso único de siempre.
+SERVE_ROLE = os.getenv("SERVE_ROLE", "all")
+WRITER_URL = os.getenv("SERVE_WRITER_URL", "")
+STATUS_PATH = os.path.join("storage", "status.json")
+# Cada cuánto el escritor publica el estado de la ingesta y los lectores lo vuelven a leer
+STATUS_INTERVAL = float(os.getenv("SERVE_STATUS_INTERVAL", 0.5))
+
+if SERVE_ROLE not in ("all", "writer", "reader"):
+    raise ValueError(f"SERVE_ROLE inválido: {SERVE_ROLE!r} (all, writer o reader)")
+
+READ_ONLY = SERVE_ROLE == "reader"
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def publish_status(status, path=STATUS_PATH, interval=STATUS_INTERVAL):
+    # Escritor: copia processing_status a disco cada vez que cambia, para que todos los
+    # workers respondan lo mismo en /progress y al decidir si ya se puede chatear
+    def loop():
+        last = None
+        while True:
+            try:
+                current = json.dumps(dict(status), sort_keys=True, default=str)
+            except RuntimeError:
+                # El dict cambió mientras se copiaba: se intenta en la próxima vuelta
+                current = last
+            if current != last:
+                try:
+                    _write_json(path, json.loads(current))
+                    last = current
+                except OSError as e:
+                    print(f"WARNING: no se pudo publicar el estado: {e}")
+            time.sleep(interval)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    t = threading.Thread(target=loop, daemon=True)
+    t.start()
+    return t
+
+
+class StatusView:
+    """Lector: último estado publicado por el escritor, releído como mucho cada interval."""
+
+    def __init__(self, path=STATUS_PATH, interval=STATUS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._status = {"progress": 0, "total": 0, "done": False, "message": ""}
+        self._next = 0.0
+
+    def get(self):
+        now = time.monotonic()
+        if now >= self._next:
+            self._next = now + self.interval
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._status = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return self._status
+
+
+_client = None
+
+
+def forward(method, path, params=None, body=None):
+    # Lector: reenvía una petición de escritura al proceso escritor
+    global _client
+    if _client is None:
+        _client = httpx.Client(base_url=WRITER_URL, timeout=30)
+    return _client.request(method, path, params=params, json=body)
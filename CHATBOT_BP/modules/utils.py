@@ -1,7 +1,72 @@
-from langdetect import detect
+import os
+import re
+from functools import lru_cache
 
-def detect_language(text):
-    try:
-        return detect(text)
-    except:
-        return "en"
+# Detector de idioma propio: determinista y rápido (langdetect es lento y puede cambiar de
+# respuesta entre llamadas). Cuenta palabras funcionales, terminaciones y letras propias de
+# cada idioma; sin evidencia suficiente no decide
+LANGUAGES = [l for l in os.getenv("LANGUAGES", "en,es").split(",") if l]
+DETECT_MAX_CHARS = int(os.getenv("LANG_DETECT_MAX_CHARS", 1000))
+DETECT_MIN_SCORE = float(os.getenv("LANG_DETECT_MIN_SCORE", 1.0))
+
+WORD_RE = re.compile(r"[^\W\d_]+")
+
+STOPWORDS = {
+    "en": set(
+        "the of and to in is are was were be been for on with as by at from that this these those "
+        "it its an or not but which what when where who how do does should must can will would "
+        "have has had all any each if then than into about after before".split()
+    ),
+    "es": set(
+        "el la los las de del y en un una unos unas es son fue ser para por con como que se su sus "
+        "al lo le les no pero o más muy este esta estos estas ese esa cuando donde cómo qué cuál "
+        "debe deben puede hay tiene entre sobre sin también según antes después".split()
+    ),
+    "pt": set(
+        "o a os as de do da dos das e em um uma é são para por com como que se seu sua não mas ou "
+        "mais muito este esta isso quando onde deve pode tem entre sobre sem também".split()
+    ),
+    "fr": set(
+        "le la les de des du et en un une est sont pour par avec comme que qui se son sa ses ne pas "
+        "mais ou plus très ce cette ces quand où doit peut il elle nous vous sur sans aussi".split()
+    ),
+}
+SUFFIXES = {
+    "en": ("ing", "tion", "ed", "ly"),
+    "es": ("ción", "ciones", "mente", "idad", "ado", "ada"),
+    "pt": ("ção", "ções", "mente", "idade"),
+    "fr": ("tion", "ment", "eur", "eux"),
+}
+LETTERS = {"es": "ñ¿¡", "pt": "ãõç", "fr": "èêàœç"}
+# palabra -> idiomas (de LANGUAGES) en los que es palabra funcional
+_STOP_LANGS = {}
+for _lang in LANGUAGES:
+    for _w in STOPWORDS.get(_lang, ()):
+        _STOP_LANGS.setdefault(_w, []).append(_lang)
+
+
+@lru_cache(maxsize=4096)
+def _detect(text):
+    words = WORD_RE.findall(text.lower())
+    if not words:
+        return None
+    scores = dict.fromkeys(LANGUAGES, 0.0)
+    for w in words:
+        for lang in _STOP_LANGS.get(w, ()):
+            scores[lang] += 1.0
+        if len(w) > 4:
+            for lang in LANGUAGES:
+                if w.endswith(SUFFIXES.get(lang, ())):
+                    scores[lang] += 0.5
+    for lang in LANGUAGES:
+        scores[lang] += sum(2.0 for ch in LETTERS.get(lang, "") if ch in text)
+    # Empate: no se decide (la respuesta no depende del orden de LANGUAGES)
+    best = max(LANGUAGES, key=lambda l: scores[l])
+    if scores[best] < DETECT_MIN_SCORE or list(scores.values()).count(scores[best]) > 1:
+        return None
+    return best
+
+
+def detect_language(text, default="en"):
+    """Código de idioma ("en", "es", ...) del texto, o default si no hay evidencia suficiente."""
+    return _detect((text or "")[:DETECT_MAX_CHARS]) or default
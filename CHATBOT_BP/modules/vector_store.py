@@ -1,50 +1,954 @@
+import io
 import os
+import json
+import glob
+import time
 import faiss
 import pickle
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
+from modules import metrics
+from modules.chunk_store import ChunkStore
+from modules.lexical import rrf
+from modules.utils import detect_language
+
+# Se compacta cuando los segmentos pendientes pesan una fracción del índice base
+# (costo amortizado lineal) o cuando hay demasiados archivos de segmento
+COMPACT_RATIO = float(os.getenv("VS_COMPACT_RATIO", 0.25))
+COMPACT_MIN_ROWS = int(os.getenv("VS_COMPACT_MIN_ROWS", 5000))
+MAX_SEGMENTS = int(os.getenv("VS_MAX_SEGMENTS", 64))
+
+# Tipo de índice: "auto", "flat" (producto interno exacto), "ivf", "hnsw", o comprimidos:
+# "sq8" (8 bits por dimensión) y "pq" (product quantization, PQ_M bytes por vector).
+# Los embeddings vienen normalizados, así que producto interno = coseno.
+INDEX_TYPE = os.getenv("VS_INDEX_TYPE", "auto")
+INDEX_TYPES = ("auto", "flat", "hnsw", "ivf", "sq8", "pq")
+# En modo auto: flat hasta HNSW_MIN_ROWS, HNSW hasta IVF_MIN_ROWS, luego IVF
+HNSW_MIN_ROWS = int(os.getenv("VS_HNSW_MIN_ROWS", 50_000))
+IVF_MIN_ROWS = int(os.getenv("VS_IVF_MIN_ROWS", 1_000_000))
+# IVF, SQ8 y PQ se reentrenan cuando el corpus crece este factor desde el último entrenamiento
+IVF_RETRAIN_GROWTH = float(os.getenv("VS_IVF_RETRAIN_GROWTH", 4.0))
+IVF_NPROBE = int(os.getenv("VS_IVF_NPROBE", 16))
+HNSW_M = int(os.getenv("VS_HNSW_M", 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv("VS_HNSW_EF_CONSTRUCTION", 200))
+# Con efSearch=64 bench/run.py (30k x 384) da recall@5 = 0.86; con 512, 1.0 a ~0.5 ms por pregunta.
+# Para k grandes (híbrido, boost) se usan al menos HNSW_EF_PER_RESULT candidatos por resultado
+HNSW_EF_SEARCH = int(os.getenv("VS_HNSW_EF_SEARCH", 512))
+HNSW_EF_PER_RESULT = int(os.getenv("VS_HNSW_EF_PER_RESULT", 4))
+
+# Índices comprimidos: la primera pasada trae RERANK_OVERSAMPLE veces más candidatos y se
+# reordenan con el producto interno exacto, leyendo los float32 de vectors.f32 (mmap)
+PQ_M = int(os.getenv("VS_PQ_M", 48))
+PQ_NBITS = int(os.getenv("VS_PQ_NBITS", 8))
+# Por debajo de esto no vale la pena comprimir (y PQ no tiene con qué entrenar): flat
+QUANT_MIN_ROWS = int(os.getenv("VS_QUANT_MIN_ROWS", 10_000))
+RERANK_OVERSAMPLE = int(os.getenv("VS_RERANK_OVERSAMPLE", 16))
+# PQ ordena mal entre vecinos casi equidistantes: se reordenan al menos estos candidatos.
+# Con menos, bench/run.py queda fuera de la tolerancia de recall contra el flat exacto
+PQ_RERANK_MIN = int(os.getenv("VS_PQ_RERANK_MIN", 512))
+
+# Búsqueda híbrida: FAISS + BM25 (FTS5) en paralelo, fusionadas con reciprocal rank fusion
+HYBRID_SEARCH = os.getenv("VS_HYBRID_SEARCH", "1") != "0"
+HYBRID_VECTOR_WEIGHT = float(os.getenv("VS_HYBRID_VECTOR_WEIGHT", 1.0))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("VS_HYBRID_LEXICAL_WEIGHT", 1.0))
+HYBRID_RRF_K = int(os.getenv("VS_HYBRID_RRF_K", 60))
+# Cada lado aporta top_k * HYBRID_CANDIDATES candidatos a la fusión
+HYBRID_CANDIDATES = int(os.getenv("VS_HYBRID_CANDIDATES", 4))
+
+# Particiones por idioma (el de cada chunk se detecta al ingerir). "restrict" busca solo en la
+# partición del idioma de la pregunta más los chunks sin idioma detectado (FAISS ni calcula la
+# distancia de los demás); "boost" busca en todo y suma LANG_BOOST a los del mismo idioma
+LANG_MODE = os.getenv("VS_LANG_MODE", "off")
+LANG_MODES = ("off", "restrict", "boost")
+LANG_BOOST = float(os.getenv("VS_LANG_BOOST", 0.05))
+LANG_BOOST_OVERSAMPLE = int(os.getenv("VS_LANG_BOOST_OVERSAMPLE", 2))
+
+# Workers de solo lectura: el índice publicado (state.json) se mapea con mmap, así las páginas
+# las comparte el page cache entre procesos; cada tanto se revisa si hay uno nuevo
+RELOAD_INTERVAL = float(os.getenv("VS_RELOAD_INTERVAL", 1.0))
+
+# Borrados: los chunks quedan como tombstones que la búsqueda filtra; el índice se reconstruye
+# sin ellos cuando pasan esta fracción de los vectores
+TOMBSTONE_RATIO = float(os.getenv("VS_TOMBSTONE_RATIO", 0.2))
+TOMBSTONE_MIN = int(os.getenv("VS_TOMBSTONE_MIN", 1000))
+
+_lexical_pool = ThreadPoolExecutor(max_workers=4)
+
+
+def _fsync_write(path, data):
+    # Escritura atómica: archivo temporal + fsync + rename
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _base(index):
+    # Índice interno de un IndexIDMap2 (los ids de FAISS son los ids estables de los chunks)
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def _index_kind(index):
+    index = _base(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if faiss.try_extract_index_ivf(index) is not None:
+        return "ivf"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "sq8"
+    if isinstance(index, faiss.IndexPQ):
+        return "pq"
+    if index.metric_type == faiss.METRIC_L2:
+        return "flat_l2"
+    return "flat"
+
+
+def _nlist_for(n):
+    return int(min(65536, max(16, 4 * np.sqrt(n))))
+
+
+def _pq_m(dim):
+    # Cantidad de subcuantizadores: tiene que dividir la dimensión
+    m = max(1, min(PQ_M, dim))
+    while dim % m:
+        m -= 1
+    return m
+
+
+def _trainable(kind, n):
+    # Los índices entrenados necesitan un mínimo de vectores
+    if kind == "ivf":
+        return n >= 39 * _nlist_for(n)
+    if kind == "sq8":
+        return n >= QUANT_MIN_ROWS
+    if kind == "pq":
+        return n >= max(QUANT_MIN_ROWS, 39 * 2 ** PQ_NBITS)
+    return True
+
+
+def _mmap_flags(kind):
+    # IO_FLAG_MMAP deja en disco las listas IVF; IO_FLAG_MMAP_IFC (faiss >= 1.8) los códigos
+    # de flat/hnsw/sq8/pq. Las dos juntas fallan al leer un IVF, por eso se elige por tipo
+    if kind == "ivf":
+        flags = faiss.IO_FLAG_MMAP
+    else:
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return flags | faiss.IO_FLAG_READ_ONLY
+
+
+def _sample(vectors, n):
+    if len(vectors) <= n:
+        return np.ascontiguousarray(vectors)
+    rng = np.random.default_rng(0)
+    return np.ascontiguousarray(vectors[np.sort(rng.choice(len(vectors), n, replace=False))])
+
+
+def build_index(kind, dim, vectors=None):
+    # Crea (y entrena si hace falta) un índice vacío del tipo pedido
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif kind == "ivf":
+        nlist = _nlist_for(len(vectors))
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(_sample(vectors, nlist * 64))
+        # Permite reconstruir vectores por posición (necesario para reconstruir el índice)
+        index.make_direct_map()
+    elif kind == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(_sample(vectors, 100_000))
+    elif kind == "pq":
+        index = faiss.IndexPQ(dim, _pq_m(dim), PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+        index.train(_sample(vectors, 64 * 2 ** PQ_NBITS))
+    else:
+        index = faiss.IndexFlatIP(dim)
+    return index
+
+
+def fuse(dense, lexical, top_k):
+    # Ids finales a partir de los candidatos (puntaje, id) de search_raw
+    if lexical is None:
+        return [i for _, i in dense[:top_k]]
+    weights = (HYBRID_VECTOR_WEIGHT, HYBRID_LEXICAL_WEIGHT)
+    rankings = ([i for _, i in dense], [i for _, i in lexical])
+    return rrf(rankings, weights, HYBRID_RRF_K)[:top_k]
+
+
+def _rows(index, start, end):
+    # (vectores, ids) de las posiciones [start, end) de un IndexIDMap2
+    if end <= start:
+        return np.empty((0, index.d), dtype="float32"), np.empty(0, dtype="int64")
+    ids = faiss.vector_to_array(index.id_map)[start:end]
+    return _base(index).reconstruct_n(start, end - start), ids
+
+
+def _next_id(index):
+    if not index.ntotal:
+        return 0
+    return int(faiss.vector_to_array(index.id_map).max()) + 1
+
+
+def _migrate_ids(index):
+    # Índices anteriores sin ids propios: el id de cada chunk era su posición
+    n = index.ntotal
+    vectors = index.reconstruct_n(0, n) if n else np.empty((0, index.d), dtype="float32")
+    kind = _index_kind(index)
+    base = faiss.IndexFlatL2(index.d) if kind == "flat_l2" else build_index(kind, index.d, vectors)
+    new = faiss.IndexIDMap2(base)
+    new.add_with_ids(vectors, np.arange(n, dtype="int64"))
+    return new
+
+
+class VectorFile:
+    """Embeddings exactos en float32, una fila por id de chunk, leídos con mmap.
+
+    No ocupan memoria del proceso: las páginas las maneja (y comparte) el page cache. Sirven
+    para reordenar los candidatos de los índices comprimidos y para reconstruir sin pérdida.
+    """
+
+    def __init__(self, path, dim, read_only=False):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = 4 * dim
+        self.read_only = read_only
+        self._map = None
+        self._f = None
+        if not read_only:
+            self._open()
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            open(self.path, "wb").close()
+        self._f = open(self.path, "r+b")
+
+    def rows(self):
+        try:
+            return os.path.getsize(self.path) // self.row_bytes
+        except OSError:
+            return 0
+
+    def write(self, start, arr):
+        self._f.seek(start * self.row_bytes)
+        self._f.write(np.ascontiguousarray(arr, dtype="float32").tobytes())
+        self._f.flush()
+
+    def sync(self):
+        os.fsync(self._f.fileno())
+
+    def truncate(self, n):
+        if self.rows() > n:
+            self._f.truncate(n * self.row_bytes)
+            self._map = None
+
+    def invalidate(self):
+        # Lectores: el escritor pudo reemplazar el archivo (reset)
+        self._map = None
+
+    def _view(self, need):
+        m = self._map
+        if m is None or len(m) < need:
+            n = self.rows()
+            if n < need:
+                return None
+            m = self._map = np.memmap(self.path, dtype="float32", mode="r", shape=(n, self.dim))
+        return m
+
+    def get(self, ids):
+        # Matriz con las filas pedidas, o None si el archivo todavía no las tiene
+        ids = np.asarray(ids, dtype="int64")
+        if not len(ids):
+            return np.empty((0, self.dim), dtype="float32")
+        m = self._view(int(ids.max()) + 1)
+        if m is None:
+            return None
+        return np.array(m[ids])
+
+    def reset(self):
+        # Se borra y se crea otro: los mmap abiertos siguen viendo el archivo anterior
+        self._map = None
+        if self._f is not None:
+            self._f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if not self.read_only:
+            self._open()
+
+    def close(self):
+        self._map = None
+        if self._f is not None:
+            self._f.close()
+
+
 class VectorStore:
-    def __init__(self, dim=512):
-        self.index_path = os.path.join("storage", "index.faiss")
-        self.data_path = os.path.join("storage", "data.pkl")
+    def __init__(self, dim=512, root="storage", index_type=None, nprobe=None, ef_search=None, hybrid=None,
+                 read_only=False):
+        self.index_type = index_type or INDEX_TYPE
+        self.hybrid = HYBRID_SEARCH if hybrid is None else hybrid
+        self.nprobe = nprobe or IVF_NPROBE
+        self.ef_search = ef_search or HNSW_EF_SEARCH
+        self.root = root
+        self.state_path = os.path.join(root, "state.json")
+        self.wal_path = os.path.join(root, "wal.log")
+        self.segments_dir = os.path.join(root, "segments")
+        os.makedirs(self.segments_dir, exist_ok=True)
         self.dim = dim
-        self.data = []
+        self._lock = threading.RLock()
+        self._compacting = None
+        # Cambia con cada add()/reset(); las cachés de consultas lo usan para invalidarse
+        self.version = 0
+        # Metadatos/texto de los chunks en disco; solo se leen los top-k de cada búsqueda
+        self.chunks = ChunkStore(os.path.join(root, "chunks.sqlite"), read_only=read_only)
+        self.vectors = VectorFile(os.path.join(root, "vectors.f32"), dim, read_only=read_only)
+        self.read_only = read_only
+        # Ids borrados que siguen en el índice; se reemplaza (no se modifica) para leerlo sin lock
+        self._tombstones = frozenset(self.chunks.tombstones())
+        self._selector = None
+        # Idioma de cada id como código de 1 byte (0 = sin idioma); se reemplaza, no se modifica
+        self._lang_codes = np.zeros(0, dtype=np.uint8)
+        self._lang_ids = {}
+        self._lang_selectors = {}
+        if read_only:
+            # Solo se ve lo que el escritor ya compactó; sin WAL ni compactaciones propias
+            self.state = {}
+            self._snapshot = None
+            self._next_reload = 0.0
+            self._data_version = self.chunks.data_version()
+            self.index = faiss.IndexIDMap2(build_index("flat", dim))
+            self.refresh(force=True)
+            return
+        # Estado base: índice compactado y último segmento incluido en él
+        self.state = {"index": "index.faiss", "last_seq": 0}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+        elif os.path.exists(os.path.join(root, "data.pkl")):
+            self.state["data"] = "data.pkl"
+        self.seq = self.state["last_seq"]
         # Inicializa FAISS index
-        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
-            print("Cargando index y datos de FAISS del disco...")
-            self.index = faiss.read_index(self.index_path)
-            with open(self.data_path, "rb") as f:
-                self.data = pickle.load(f)
+        index_path = os.path.join(root, self.state["index"])
+        if os.path.exists(index_path):
+            print("Cargando index de FAISS del disco...")
+            self.index = faiss.read_index(index_path)
+            if _index_kind(self.index) == "ivf":
+                faiss.extract_index_ivf(self.index).make_direct_map()
         else:
             print("No hay index FAISS guardado, se crea nuevo.")
-            self.index = faiss.IndexFlatL2(dim)
+            self.index = faiss.IndexIDMap2(build_index("flat", dim))
+        if not isinstance(self.index, faiss.IndexIDMap2):
+            print("Migrando el índice FAISS a ids de chunk estables...")
+            self.index = _migrate_ids(self.index)
+        if "data" in self.state:
+            self._migrate_pickle(os.path.join(root, self.state["data"]))
+        self.state.setdefault("trained_rows", self.index.ntotal)
+        # Próximo id de chunk; los ids no se reutilizan aunque se borren documentos
+        self.next_id = self.state.get("next_id", _next_id(self.index))
+        self._pending_rows = 0
+        self._backfill_vectors()
+        self._replay_wal()
+        # Filas escritas en SQLite (o en vectors.f32) cuyo segmento no llegó al WAL
+        self.chunks.truncate(self.next_id)
+        self.vectors.truncate(self.next_id)
+        self._load_langs(self.next_id)
+        if self._needs_compaction() or self._needs_rebuild():
+            self.compact(wait=False)
+
+    def _published_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        if os.path.exists(os.path.join(self.root, "index.faiss")):
+            # Formato anterior, sin state.json
+            return {"index": "index.faiss", "last_seq": 0}
+        return None
+
+    def refresh(self, force=False):
+        """Solo lectura: cambia al último índice publicado, sin cortar las búsquedas en curso
+        (cada búsqueda usa la referencia al índice que tomó al empezar)."""
+        if not self.read_only:
+            return False
+        now = time.monotonic()
+        if not force and now < self._next_reload:
+            return False
+        if not self._lock.acquire(blocking=False):
+            # Otro hilo ya está recargando
+            return False
+        try:
+            self._next_reload = now + RELOAD_INTERVAL
+            self._refresh_tombstones()
+            try:
+                state = self._published_state()
+            except ValueError:
+                return False
+            snapshot = (state["index"], state["last_seq"]) if state else None
+            if snapshot == self._snapshot:
+                return False
+            if state is None:
+                index = build_index("flat", self.dim)
+            else:
+                try:
+                    index = faiss.read_index(
+                        os.path.join(self.root, state["index"]), _mmap_flags(state.get("index_type")),
+                    )
+                except RuntimeError:
+                    # El escritor lo reemplazó mientras se leía: se reintenta en la próxima revisión
+                    return False
+                if _index_kind(index) == "ivf":
+                    faiss.extract_index_ivf(index).make_direct_map()
+                if not isinstance(index, faiss.IndexIDMap2):
+                    # Índice del formato anterior: se convierte en memoria hasta que el escritor compacte
+                    index = _migrate_ids(index)
+            self.index = index
+            self.vectors.invalidate()
+            end = (state or {}).get("next_id", _next_id(index))
+            if end < len(self._lang_codes):
+                # Reset del escritor: los ids vuelven a empezar
+                self._lang_codes = np.zeros(0, dtype=np.uint8)
+            self._load_langs(end)
+            self.state = state or {}
+            self._snapshot = snapshot
+            self.version += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def _refresh_tombstones(self):
+        version = self.chunks.data_version()
+        if version == self._data_version:
+            return
+        self._data_version = version
+        dead = frozenset(self.chunks.tombstones())
+        if dead != self._tombstones:
+            self._tombstones = dead
+            self.version += 1
+
+    def _backfill_vectors(self):
+        # vectors.f32 de un storage anterior (o perdido): se arma desde el índice compactado
+        have = self.vectors.rows()
+        if have >= self.next_id or not self.index.ntotal:
+            return
+        if _index_kind(self.index) in ("sq8", "pq"):
+            print("WARNING: faltan vectores exactos; se reconstruyen desde el índice comprimido")
+        print(f"Copiando vectores a {self.vectors.path}...")
+        ids = faiss.vector_to_array(self.index.id_map)
+        ids = np.sort(ids[ids >= have])
+        # Los ids purgados quedan como filas en cero
+        self.vectors.write(have, np.zeros((self.next_id - have, self.dim), dtype="float32"))
+        for i in range(0, len(ids), 65536):
+            block = ids[i:i + 65536]
+            vecs = self.index.reconstruct_batch(block)
+            for run in np.split(np.arange(len(block)), np.nonzero(np.diff(block) != 1)[0] + 1):
+                self.vectors.write(int(block[run[0]]), vecs[run])
+        self.vectors.sync()
+
+    def _exact(self, index, start, end):
+        # (vectores, ids) de las posiciones [start, end), con los float32 de vectors.f32
+        ids = faiss.vector_to_array(index.id_map)[start:end]
+        exact = self.vectors.get(ids) if end > start else None
+        if exact is None:
+            return _rows(index, start, end)
+        return exact, ids
+
+    def _lang_code(self, lang):
+        if lang is None:
+            return 0
+        code = self._lang_ids.get(lang)
+        if code is None:
+            code = self._lang_ids[lang] = min(255, len(self._lang_ids) + 1)
+        return code
+
+    def _set_langs(self, start, end, rows):
+        # rows: (id, idioma) con start <= id < end
+        codes = np.zeros(max(end, len(self._lang_codes)), dtype=np.uint8)
+        codes[:len(self._lang_codes)] = self._lang_codes
+        for i, lang in rows:
+            codes[i] = self._lang_code(lang)
+        self._lang_codes = codes
+
+    def _load_langs(self, end):
+        # Idiomas de los ids que todavía no se conocen, hasta end (exclusivo)
+        start = len(self._lang_codes)
+        if end > start:
+            self._set_langs(start, end, self.chunks.langs(start, end))
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"VectorStore de solo lectura: {self.root}")
+
+    def _migrate_pickle(self, data_path):
+        # Migración única desde data.pkl (lista de dicts) a SQLite
+        if os.path.exists(data_path) and self.chunks.is_empty():
+            print(f"Migrando {data_path} a SQLite...")
+            with open(data_path, "rb") as f:
+                self.chunks.add(0, pickle.load(f))
+        del self.state["data"]
+        _fsync_write(self.state_path, json.dumps(self.state).encode())
+        if os.path.exists(data_path):
+            os.remove(data_path)
+
+    def _segment_paths(self, seq):
+        name = os.path.join(self.segments_dir, f"seg-{seq:08d}")
+        return name + ".npy", name + ".pkl"
+
+    def _read_wal(self):
+        entries = []
+        if not os.path.exists(self.wal_path):
+            return entries
+        with open(self.wal_path, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Última línea incompleta por un corte: se ignora
+                    break
+        return entries
+
+    def _replay_wal(self):
+        # Aplica los segmentos escritos después del último compactado
+        for entry in self._read_wal():
+            seq = entry["seq"]
+            if seq <= self.state["last_seq"]:
+                continue
+            vec_path, meta_path = self._segment_paths(seq)
+            if not os.path.exists(vec_path):
+                break
+            arr = np.load(vec_path)
+            # Entradas anteriores a los ids estables: los ids seguían la posición
+            start = entry.get("start", self.next_id)
+            if os.path.exists(meta_path):
+                # Segmento del formato anterior, con los metadatos en pickle
+                with open(meta_path, "rb") as f:
+                    self.chunks.add(start, pickle.load(f))
+            self.vectors.write(start, arr)
+            self.index.add_with_ids(arr, np.arange(start, start + len(arr), dtype="int64"))
+            self.next_id = max(self.next_id, start + len(arr))
+            self.seq = seq
+            self._pending_rows += len(arr)
+
+    def _needs_compaction(self):
+        if self.seq - self.state["last_seq"] >= MAX_SEGMENTS:
+            return True
+        base_rows = self.index.ntotal - self._pending_rows
+        return self._pending_rows >= max(COMPACT_MIN_ROWS, COMPACT_RATIO * base_rows)
+
+    def _desired_kind(self, n):
+        if self.index_type != "auto":
+            return self.index_type
+        if n < HNSW_MIN_ROWS:
+            return "flat"
+        if n < IVF_MIN_ROWS:
+            return "hnsw"
+        return "ivf"
+
+    def _needs_rebuild(self):
+        n = self.index.ntotal
+        if len(self._tombstones) >= max(TOMBSTONE_MIN, TOMBSTONE_RATIO * n):
+            return True
+        kind = _index_kind(self.index)
+        if kind != self._desired_kind(n):
+            # IVF, SQ8 y PQ necesitan un mínimo de vectores para entrenar
+            return _trainable(self._desired_kind(n), n)
+        if kind in ("ivf", "sq8", "pq"):
+            return n > IVF_RETRAIN_GROWTH * max(1, self.state.get("trained_rows", 0))
+        return False
+
+    def _rebuild(self):
+        # Reconstruye el índice con el tipo adecuado y sin los tombstones, sin bloquear las
+        # búsquedas ni los add(). Devuelve los ids purgados
+        with self._lock:
+            old = self.index
+            n = old.ntotal
+            vectors, ids = self._exact(old, 0, n)
+            dead = self._tombstones
+        if dead:
+            keep = ~np.isin(ids, np.fromiter(dead, dtype="int64", count=len(dead)))
+            vectors, ids = vectors[keep], ids[keep]
+        kind = self._desired_kind(len(ids))
+        if not _trainable(kind, len(ids)):
+            # Quedaron muy pocos vectores para entrenar
+            kind = "flat"
+        print(f"Reconstruyendo índice FAISS: {_index_kind(old)} -> {kind} ({len(ids)} vectores, {n - len(ids)} borrados)")
+        with metrics.span("index_rebuild"):
+            index = faiss.IndexIDMap2(build_index(kind, self.dim, vectors))
+            index.add_with_ids(vectors, ids)
+        with self._lock:
+            if self.index is not old:
+                return set()
+            # Vectores que llegaron mientras se construía
+            index.add_with_ids(*self._exact(old, n, old.ntotal))
+            self.index = index
+            self.state["trained_rows"] = len(ids)
+            # Los borrados durante la reconstrucción siguen filtrándose
+            self._tombstones = self._tombstones - dead
+            self._selector = None
+            return set(dead)
 
     def add(self, embeddings, chunks):
+        self._check_writable()
         arr = np.array(embeddings, dtype="float32")
-        print("FAISS espera dimensión:", self.dim)
-        print("Embeddings tienen shape:", arr.shape)
-        self.index.add(arr)
-        self.data.extend(chunks)
-        self._save()
-
-    def _save(self):
-        faiss.write_index(self.index, self.index_path)
-        with open(self.data_path, "wb") as f:
-            pickle.dump(self.data, f)
-
-    def search(self, query_embedding, top_k=5):
-        arr = np.array([query_embedding], dtype="float32")
-        D, I = self.index.search(arr, top_k)
-        return [self.data[i] for i in I[0] if i < len(self.data)]
+        # La ingesta ya trae el idioma de cada chunk; si no, se detecta acá
+        chunks = [
+            c if "lang" in c else {**c, "lang": detect_language(c.get("text"), default=None)}
+            for c in chunks
+        ]
+        with self._lock:
+            seq = self.seq + 1
+            # 1) segmento de vectores, 2) metadatos en SQLite, 3) entrada en el WAL,
+            # 4) vectors.f32 (sin fsync: el WAL lo rehace), 5) índice
+            vec_path, _ = self._segment_paths(seq)
+            start = self.next_id
+            with metrics.span("persist"):
+                buf = io.BytesIO()
+                np.save(buf, arr)
+                _fsync_write(vec_path, buf.getvalue())
+                self.chunks.add(start, chunks)
+                with open(self.wal_path, "a") as f:
+                    f.write(json.dumps({"seq": seq, "n": len(chunks), "start": start}) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.vectors.write(start, arr)
+            self._set_langs(start, start + len(arr), [(start + k, c["lang"]) for k, c in enumerate(chunks)])
+            with metrics.span("index_add"):
+                self.index.add_with_ids(arr, np.arange(start, start + len(arr), dtype="int64"))
+            self.next_id = start + len(arr)
+            self.seq = seq
+            self._pending_rows += len(chunks)
+            self.version += 1
+            if self._needs_compaction() or self._needs_rebuild():
+                self.compact(wait=False)
+
+    def remove_document(self, source=None, h=None):
+        """Borra los chunks de un documento (por nombre de origen o por hash del contenido).
+
+        Es un tombstone: la búsqueda deja de verlos al instante y el espacio en el índice se
+        recupera en la próxima reconstrucción. Devuelve cuántos chunks se borraron.
+        """
+        self._check_writable()
+        with self._lock:
+            ids = self.chunks.remove(source=source, h=h)
+            if ids:
+                self._tombstones = self._tombstones | set(ids)
+                self._selector = None
+                self.version += 1
+                if self._needs_rebuild():
+                    self.compact(wait=False)
+        return len(ids)
+
+    def replace_document(self, embeddings, chunks, source=None, h=None):
+        # Versión nueva de un documento: ninguna búsqueda ve las dos versiones a la vez
+        with self._lock:
+            removed = self.remove_document(source=source, h=h)
+            self.add(embeddings, chunks)
+        return removed
+
+    def compact(self, wait=True):
+        # Fusiona los segmentos en un nuevo índice base, en segundo plano
+        self._check_writable()
+        with self._lock:
+            if self._compacting is None or not self._compacting.is_alive():
+                self._compacting = threading.Thread(target=self._compact, daemon=True)
+                self._compacting.start()
+            t = self._compacting
+        if wait:
+            t.join()
+
+    def _compact(self):
+        with metrics.span("compaction"):
+            self._do_compact()
+
+    def _do_compact(self):
+        rebuilt = self._needs_rebuild()
+        purged = self._rebuild() if rebuilt else set()
+        with self._lock:
+            seq = self.seq
+            # Sin next_id, el índice en disco es del formato anterior y hay que reescribirlo
+            if seq == self.state["last_seq"] and not rebuilt and "next_id" in self.state:
+                return
+            index_bytes = faiss.serialize_index(self.index)
+            old = dict(self.state)
+            old["index_type"] = _index_kind(self.index)
+            rows = self._pending_rows
+            next_id = self.next_id
+        new_state = {
+            "index": f"index-{seq:08d}.faiss",
+            "last_seq": seq,
+            "index_type": old["index_type"],
+            "trained_rows": old["trained_rows"],
+            "next_id": next_id,
+        }
+        _fsync_write(os.path.join(self.root, new_state["index"]), index_bytes.tobytes())
+        with self._lock:
+            if self._compacting is not threading.current_thread():
+                # Hubo un reset mientras se compactaba: se descarta el resultado
+                old = new_state
+            else:
+                # Los segmentos se borran: sus filas de vectors.f32 tienen que estar en disco
+                self.vectors.sync()
+                _fsync_write(self.state_path, json.dumps(new_state).encode())
+                self.state = new_state
+                self._pending_rows -= rows
+                # El WAL conserva solo los segmentos que llegaron durante la compactación
+                keep = [e for e in self._read_wal() if e["seq"] > seq]
+                _fsync_write(self.wal_path, "".join(json.dumps(e) + "\n" for e in keep).encode())
+                for path in glob.glob(os.path.join(self.segments_dir, "seg-*")):
+                    if int(os.path.basename(path)[4:12]) <= seq:
+                        os.remove(path)
+                # El índice persistido ya no tiene los vectores purgados
+                self.chunks.clear_tombstones(purged)
+            if old["index"] != self.state["index"]:
+                old_path = os.path.join(self.root, old["index"])
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+
+    def _tombstone_selector(self):
+        # IDSelector que excluye los borrados; se arma una vez por cada conjunto de tombstones
+        dead = self._tombstones
+        if not dead:
+            return None
+        cached = self._selector
+        if cached is None or cached[0] is not dead:
+            batch = faiss.IDSelectorBatch(np.fromiter(dead, dtype="int64", count=len(dead)))
+            cached = self._selector = (dead, faiss.IDSelectorNot(batch), batch)
+        return cached[1]
+
+    def _lang_selector(self, lang):
+        # (IDSelector, máscara por id) de la partición de un idioma, sin los tombstones.
+        # Bitmap de 1 bit por id: se arma una vez por cada estado de idiomas y tombstones
+        codes, dead = self._lang_codes, self._tombstones
+        cached = self._lang_selectors.get(lang)
+        if cached is None or cached[0] is not codes or cached[1] is not dead:
+            code = self._lang_ids.get(lang)
+            mask = codes == 0
+            if code is not None:
+                mask |= codes == code
+            if dead:
+                gone = np.fromiter(dead, dtype="int64", count=len(dead))
+                mask[gone[gone < len(mask)]] = False
+            bitmap = np.packbits(mask, bitorder="little")
+            cached = (codes, dead, mask, bitmap, faiss.IDSelectorBitmap(bitmap))
+            self._lang_selectors[lang] = cached
+        return cached[4], cached[2]
+
+    def _search_params(self, index, k, nprobe=None, ef_search=None, sel=None):
+        kind = _index_kind(index)
+        if kind == "pq":
+            # IndexPQ no acepta IDSelector: los tombstones (y la partición) se filtran al reordenar
+            return None
+        extra = {}
+        sel = sel or self._tombstone_selector()
+        if sel is not None:
+            extra["sel"] = sel
+        if kind == "ivf":
+            return faiss.SearchParametersIVF(nprobe=nprobe or self.nprobe, **extra)
+        if kind == "hnsw":
+            ef = max(ef_search or self.ef_search, HNSW_EF_PER_RESULT * k)
+            return faiss.SearchParametersHNSW(efSearch=ef, **extra)
+        return faiss.SearchParameters(**extra) if extra else None
+
+    def search_ids(self, query_embedding, top_k=5, nprobe=None, ef_search=None, query_text=None,
+                   lang=None, lang_mode=None):
+        query_texts = None if query_text is None else [query_text]
+        return self.search_ids_batch(
+            [query_embedding], top_k, nprobe, ef_search, query_texts, [lang], lang_mode,
+        )[0]
+
+    def _search_text(self, text, top_k, lang=None):
+        with metrics.span("lexical_search"):
+            return self.chunks.search_text(text, top_k, scores=True, lang=lang)
+
+    def search_raw(self, query_embeddings, depth, nprobe=None, ef_search=None, query_texts=None,
+                   langs=None, lang_mode=None):
+        """Candidatos sin fusionar: por pregunta, (densos, léxicos) como listas de (puntaje, id)
+        ordenadas de mejor a peor; léxicos es None sin query_texts. Sirve para mezclar shards.
+        langs: idioma de cada pregunta (o None) para lang_mode "restrict"/"boost"."""
+        self.refresh()
+        arr = np.array(query_embeddings, dtype="float32").reshape(-1, self.dim)
+        mode = lang_mode or LANG_MODE
+        if mode == "off" or langs is None or all(l is None for l in langs):
+            langs = [None] * len(arr)
+        restrict = mode == "restrict"
+        hybrid = self.hybrid and query_texts is not None
+        if hybrid:
+            # BM25 corre en otros hilos mientras FAISS busca (SQLite y FAISS sueltan el GIL)
+            lexical = [
+                _lexical_pool.submit(
+                    contextvars.copy_context().run, self._search_text, t, depth, l if restrict else None,
+                )
+                for t, l in zip(query_texts, langs)
+            ]
+        index = self.index
+        if restrict:
+            # Una búsqueda por idioma, cada una sobre su partición
+            dense = [None] * len(arr)
+            groups = {}
+            for q, l in enumerate(langs):
+                groups.setdefault(l, []).append(q)
+            for l, rows in groups.items():
+                sel, mask = self._lang_selector(l) if l is not None else (None, None)
+                for q, d in zip(rows, self._dense(index, arr[rows], depth, nprobe, ef_search, sel, mask)):
+                    dense[q] = d
+        elif any(l is not None for l in langs):
+            # Boost: más candidatos, se suma LANG_BOOST a los del idioma y se reordena
+            wide = self._dense(index, arr, depth * LANG_BOOST_OVERSAMPLE, nprobe, ef_search)
+            dense = [self._boost(d, l, depth) for d, l in zip(wide, langs)]
+        else:
+            dense = self._dense(index, arr, depth, nprobe, ef_search)
+        if not hybrid:
+            return [(d, None) for d in dense]
+        return [(d, [(s, i) for i, s in fut.result()]) for d, fut in zip(dense, lexical)]
+
+    def _dense(self, index, arr, depth, nprobe=None, ef_search=None, sel=None, mask=None):
+        kind = _index_kind(index)
+        compressed = kind in ("sq8", "pq")
+        k = depth * RERANK_OVERSAMPLE if compressed else depth
+        if kind == "pq":
+            k = max(k, PQ_RERANK_MIN)
+        with metrics.span("faiss_search"):
+            D, I = index.search(arr, k, params=self._search_params(index, k, nprobe, ef_search, sel))
+        if compressed:
+            with metrics.span("rerank"):
+                return [self._rerank(q, irow, drow, depth, mask) for q, drow, irow in zip(arr, D, I)]
+        # Índices L2 heredados: menor distancia = mejor
+        sign = -1.0 if index.metric_type == faiss.METRIC_L2 else 1.0
+        return [
+            [(sign * float(d), int(i)) for d, i in zip(drow, irow) if i >= 0]
+            for drow, irow in zip(D, I)
+        ]
+
+    def _rerank(self, query, ids, approx, depth, mask=None):
+        # Reordena los candidatos del índice comprimido con el producto interno exacto
+        dead = self._tombstones
+        valid = ids >= 0
+        if dead:
+            valid &= np.array([int(i) not in dead for i in ids], dtype=bool)
+        if mask is not None:
+            valid &= np.array([0 <= i < len(mask) and mask[i] for i in ids], dtype=bool)
+        ids, approx = ids[valid], approx[valid]
+        vecs = self.vectors.get(ids)
+        if vecs is None:
+            # Sin vectores exactos (p. ej. un lector con un archivo a medio copiar)
+            return [(float(d), int(i)) for d, i in zip(approx, ids)][:depth]
+        scores = vecs @ query
+        order = np.argsort(-scores, kind="stable")[:depth]
+        return [(float(scores[j]), int(ids[j])) for j in order]
+
+    def _boost(self, dense, lang, depth):
+        code = self._lang_ids.get(lang)
+        if code is None:
+            return dense[:depth]
+        codes = self._lang_codes
+        boosted = [
+            (s + LANG_BOOST if i < len(codes) and codes[i] == code else s, i) for s, i in dense
+        ]
+        boosted.sort(key=lambda x: -x[0])
+        return boosted[:depth]
+
+    def search_ids_batch(self, query_embeddings, top_k=5, nprobe=None, ef_search=None, query_texts=None,
+                         langs=None, lang_mode=None):
+        # Una sola búsqueda FAISS con una fila por pregunta; con query_texts, además BM25 y RRF
+        hybrid = self.hybrid and query_texts is not None
+        depth = top_k * HYBRID_CANDIDATES if hybrid else top_k
+        raw = self.search_raw(query_embeddings, depth, nprobe, ef_search, query_texts, langs, lang_mode)
+        return [fuse(dense, lexical, top_k) for dense, lexical in raw]
+
+    def get_chunks(self, ids):
+        return self.chunks.get_many(ids)
+
+    def get_vectors(self, ids):
+        # Embeddings guardados de unos pocos ids ({id: vector}); None si no están
+        ids = [int(i) for i in ids]
+        vecs = self.vectors.get(ids)
+        if vecs is not None:
+            return dict(zip(ids, vecs))
+        index = self.index
+        try:
+            return {int(i): index.reconstruct(int(i)) for i in ids}
+        except RuntimeError:
+            return None
+
+    def search(self, query_embedding, top_k=5, nprobe=None, ef_search=None, query_text=None,
+               lang=None, lang_mode=None):
+        return self.get_chunks(
+            self.search_ids(query_embedding, top_k, nprobe, ef_search, query_text, lang, lang_mode)
+        )
+
+    def get_chunk_map(self, ids):
+        return self.chunks.get_map(ids)
+
+    def hashes(self):
+        return self.chunks.hashes()
+
+    @property
+    def ntotal(self):
+        # Vectores vivos (sin contar los tombstones)
+        return max(0, self.index.ntotal - len(self._tombstones))
+
+    def memory_bytes(self):
+        # Estimación de la memoria del índice FAISS (sin serializarlo). vectors.f32 no cuenta:
+        # está mapeado y lo maneja el page cache
+        index = self.index
+        n, kind = index.ntotal, _index_kind(index)
+        # Vector + su id en el id_map y en el mapa inverso
+        per_vector = 4 * self.dim + 24
+        if kind in ("sq8", "pq"):
+            base = _base(index)
+            per_vector = base.code_size + 24
+            if kind == "pq":
+                return n * per_vector + base.pq.M * base.pq.ksub * base.pq.dsub * 4
+            return n * per_vector + 8 * self.dim
+        if kind == "hnsw":
+            per_vector += 8 * HNSW_M
+        elif kind == "ivf":
+            per_vector += 8
+            n_lists = faiss.extract_index_ivf(index).nlist
+            return n * per_vector + n_lists * 4 * self.dim
+        return n * per_vector
+
+    def busy(self):
+        return self._compacting is not None and self._compacting.is_alive()
+
+    def wait_compaction(self):
+        t = self._compacting
+        if t is not None and t.is_alive():
+            t.join()
+
+    def close(self):
+        # Espera la compactación en curso y libera el SQLite
+        self.wait_compaction()
+        self.chunks.conn.close()
+        self.vectors.close()
 
     def has_knowledge(self):
         # Hay algo cargado si el index no está vacío y hay chunks
-        return hasattr(self.index, "ntotal") and self.index.ntotal > 0 and len(self.data) > 0
+        return self.ntotal > 0 and not self.chunks.is_empty()
 
     def reset(self):
-        self.index = faiss.IndexFlatL2(self.dim)
-        self.data = []
-        if os.path.exists(self.index_path):
-            os.remove(self.index_path)
-        if os.path.exists(self.data_path):
-            os.remove(self.data_path)
+        self._check_writable()
+        with self._lock:
+            self._compacting = None
+            self.index = faiss.IndexIDMap2(build_index("flat", self.dim))
+            self.chunks.reset()
+            self.vectors.reset()
+            self._tombstones = frozenset()
+            self._selector = None
+            self._lang_codes = np.zeros(0, dtype=np.uint8)
+            self._lang_selectors = {}
+            self.next_id = 0
+            paths = [self.state_path, self.wal_path]
+            paths += glob.glob(os.path.join(self.root, "index*.faiss"))
+            paths += glob.glob(os.path.join(self.root, "data*.pkl"))
+            paths += glob.glob(os.path.join(self.segments_dir, "seg-*"))
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.state = {"index": "index.faiss", "last_seq": 0, "trained_rows": 0}
+            self.seq = 0
+            self._pending_rows = 0
+            self.version += 1
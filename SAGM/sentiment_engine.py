@@ -0,0 +1,303 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+
+import numpy as np
+
+# Motor de inferencia de sentimiento con el checkpoint robertuito ajustado.
+# El modelo se carga una sola vez por proceso; los segmentos se ordenan por cantidad de tokens
+# y se agrupan en lotes de largo parecido, con padding solo hasta el más largo de cada lote
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.getenv("SAGM_MODEL_DIR") or os.path.join(BASE_DIR, "model_checkpoints", "robertuito_autodinamico")
+# "torch" (por defecto), "onnx" o "onnx-int8" (ONNX con cuantización dinámica int8, solo CPU)
+BACKEND = os.getenv("SAGM_BACKEND", "torch")
+BACKENDS = ("torch", "onnx", "onnx-int8")
+# robertuito se entrenó con secuencias de 128 tokens
+MAX_TOKENS = int(os.getenv("SAGM_MAX_TOKENS", 128))
+BATCH_SIZE = int(os.getenv("SAGM_BATCH_SIZE", 64))
+# Tope de tokens por lote (filas x largo con padding): los lotes de segmentos cortos son más grandes
+MAX_BATCH_TOKENS = int(os.getenv("SAGM_MAX_BATCH_TOKENS", 8192))
+THREADS = int(os.getenv("SAGM_THREADS", 0)) or os.cpu_count()
+# Si el modelo ONNX no coincide con torch en al menos esta fracción de etiquetas, se usa torch
+MIN_LABEL_AGREEMENT = float(os.getenv("SAGM_MIN_LABEL_AGREEMENT", 0.98))
+MAX_PROB_DIFF = float(os.getenv("SAGM_MAX_PROB_DIFF", 0.1))
+
+SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+")
+
+_engines = {}
+# Reentrante: exportar o descartar un backend ONNX pide el motor torch mientras se carga
+_lock = threading.RLock()
+
+
+def get_engine(backend=None, model_dir=None):
+    """Motor compartido: se carga la primera vez que se pide y una sola vez por proceso."""
+    key = (backend or BACKEND, model_dir or MODEL_DIR)
+    with _lock:
+        if key not in _engines:
+            _engines[key] = _load_engine(*key)
+        return _engines[key]
+
+
+def _load_engine(backend, model_dir):
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend desconocido: {backend} ({', '.join(BACKENDS)})")
+    if backend == "torch":
+        return SentimentEngine(model_dir)
+    report = _read_report(model_dir, backend)
+    if report is None:
+        report = export_onnx_model(model_dir, quantize=backend == "onnx-int8")
+    if not report["ok"]:
+        print(f"Modelo {backend} descartado (acuerdo {report['label_agreement']:.4f}, "
+              f"diferencia máxima {report['max_prob_diff']:.4f}), se usa torch")
+        return get_engine("torch", model_dir)
+    return SentimentEngine(model_dir, backend)
+
+
+def split_segments(text):
+    """Segmentos de una transcripción: una línea por segmento y, dentro de cada línea, oraciones."""
+    segments = []
+    for line in text.splitlines():
+        segments.extend(s.strip() for s in SENTENCE_RE.split(line) if s.strip())
+    return segments
+
+
+def make_batches(lengths, batch_size=BATCH_SIZE, max_batch_tokens=MAX_BATCH_TOKENS):
+    # Índices ordenados por largo y cortados en lotes: cada lote se rellena hasta su propio máximo
+    order = np.argsort(lengths, kind="stable")
+    batches, current, longest = [], [], 0
+    for i in order:
+        n = int(lengths[i])
+        if current and (len(current) >= batch_size or max(longest, n) * (len(current) + 1) > max_batch_tokens):
+            batches.append(current)
+            current, longest = [], 0
+        current.append(int(i))
+        longest = max(longest, n)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _softmax(logits):
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+class SentimentEngine:
+    def __init__(self, model_dir=MODEL_DIR, backend="torch", threads=THREADS):
+        from transformers import AutoConfig, AutoTokenizer
+
+        self.model_dir = model_dir
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        config = AutoConfig.from_pretrained(model_dir)
+        self.labels = [config.id2label[i] for i in range(len(config.id2label))]
+        self.max_tokens = min(MAX_TOKENS, self.tokenizer.model_max_length)
+        self.backend = backend
+        if backend != "torch":
+            import onnxruntime as ort
+
+            opts = ort.SessionOptions()
+            opts.intra_op_num_threads = threads
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = ort.InferenceSession(_onnx_path(model_dir, backend), opts, providers=["CPUExecutionProvider"])
+            self.input_names = [i.name for i in self.session.get_inputs()]
+            self.model = None
+        else:
+            import torch
+            from transformers import AutoModelForSequenceClassification
+
+            torch.set_num_threads(threads)
+            self.model = AutoModelForSequenceClassification.from_pretrained(model_dir).eval()
+            self.session = None
+
+    def _forward(self, features):
+        # Lote con padding dinámico (hasta el segmento más largo del lote) -> logits en numpy
+        if self.session is not None:
+            batch = self.tokenizer.pad(features, return_tensors="np")
+            feeds = {k: batch[k].astype(np.int64) for k in self.input_names if k in batch}
+            return self.session.run(None, feeds)[0]
+        import torch
+
+        batch = self.tokenizer.pad(features, return_tensors="pt")
+        with torch.inference_mode():
+            return self.model(**batch).logits.float().numpy()
+
+    def predict_proba(self, texts, batch_size=BATCH_SIZE):
+        """Probabilidades (n, etiquetas) para cada texto, en el mismo orden que texts."""
+        if not texts:
+            return np.zeros((0, len(self.labels)), dtype=np.float32)
+        # Se tokeniza todo una vez, sin padding, para conocer el largo de cada segmento
+        enc = self.tokenizer(list(texts), truncation=True, max_length=self.max_tokens)
+        keys = [k for k in ("input_ids", "attention_mask", "token_type_ids") if k in enc]
+        lengths = np.array([len(ids) for ids in enc["input_ids"]])
+        probs = np.zeros((len(texts), len(self.labels)), dtype=np.float32)
+        for idx in make_batches(lengths, batch_size):
+            features = [{k: enc[k][i] for k in keys} for i in idx]
+            probs[idx] = _softmax(self._forward(features))
+        return probs
+
+    def predict(self, texts, batch_size=BATCH_SIZE):
+        """Etiqueta, probabilidad y probabilidades por etiqueta de cada texto."""
+        probs = self.predict_proba(texts, batch_size)
+        results = []
+        for text, p in zip(texts, probs):
+            best = int(p.argmax())
+            results.append({
+                "text": text,
+                "label": self.labels[best],
+                "score": float(p[best]),
+                "scores": {label: float(x) for label, x in zip(self.labels, p)},
+            })
+        return results
+
+    def analyze_text(self, text, batch_size=BATCH_SIZE):
+        """Sentimiento de cada segmento de una transcripción y un resumen del total."""
+        results = self.predict(split_segments(text), batch_size)
+        counts = {label: 0 for label in self.labels}
+        for r in results:
+            counts[r["label"]] += 1
+        mean = {
+            label: (float(np.mean([r["scores"][label] for r in results])) if results else 0.0)
+            for label in self.labels
+        }
+        return {"segments": results, "summary": {"segments": len(results), "counts": counts, "mean_scores": mean}}
+
+
+# ------------------------------------------------------------------ ONNX / int8
+
+def _onnx_path(model_dir, backend):
+    name = "model_qint8.onnx" if backend == "onnx-int8" else "model.onnx"
+    return os.path.join(model_dir, "onnx", name)
+
+
+def _read_report(model_dir, backend):
+    path = os.path.join(model_dir, "onnx", f"accuracy_{backend}.json")
+    if not os.path.exists(_onnx_path(model_dir, backend)) or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def export_onnx_model(model_dir=MODEL_DIR, quantize=True):
+    # Exporta a ONNX (ejes dinámicos de lote y largo), opcionalmente cuantiza los pesos a int8
+    # y compara contra el modelo torch
+    import torch
+
+    out_dir = os.path.join(model_dir, "onnx")
+    os.makedirs(out_dir, exist_ok=True)
+    reference = get_engine("torch", model_dir)
+    fp32_path = _onnx_path(model_dir, "onnx")
+    if not os.path.exists(fp32_path):
+        print(f"Exportando {model_dir} a ONNX...")
+        sample = reference.tokenizer(["texto de ejemplo", "otro texto"], padding=True, return_tensors="pt")
+        names = [k for k in ("input_ids", "attention_mask") if k in sample]
+        axes = {k: {0: "batch", 1: "sequence"} for k in names}
+        axes["logits"] = {0: "batch"}
+        with torch.inference_mode():
+            torch.onnx.export(
+                reference.model, tuple(sample[k] for k in names), fp32_path,
+                input_names=names, output_names=["logits"], dynamic_axes=axes, opset_version=14,
+            )
+    backend = "onnx"
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        backend = "onnx-int8"
+        print("Cuantizando a int8...")
+        quantize_dynamic(fp32_path, _onnx_path(model_dir, backend), weight_type=QuantType.QInt8)
+    report = compare_engines(reference, SentimentEngine(model_dir, backend))
+    report["ok"] = report["label_agreement"] >= MIN_LABEL_AGREEMENT and report["max_prob_diff"] <= MAX_PROB_DIFF
+    with open(os.path.join(out_dir, f"accuracy_{backend}.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+SAMPLE_TEXTS = [
+    "Me encantó el video, está muy bien explicado.",
+    "No entiendo nada de lo que dice, es una pérdida de tiempo.",
+    "Hoy vamos a hablar de los resultados del último trimestre.",
+    "Qué vergüenza, otra vez lo mismo.",
+    "Gracias a todos por estar acá, de verdad.",
+    "El producto llegó roto y nadie responde los mensajes.",
+    "La reunión empieza a las diez.",
+    "Estoy muy contento con cómo salió todo.",
+    "Esto es lo peor que vi en mucho tiempo.",
+    "Bueno, no sé, puede ser.",
+    "¡Excelente trabajo del equipo!",
+    "Nadie me avisó del cambio y ahora tengo que rehacer todo.",
+]
+
+
+def compare_engines(reference, candidate, texts=None):
+    # Diferencia de probabilidades y acuerdo de etiquetas entre dos motores, y el tiempo de cada uno
+    texts = texts or SAMPLE_TEXTS
+    probs, timings = {}, {}
+    for name, engine in (("reference", reference), ("candidate", candidate)):
+        engine.predict_proba(texts[:2])  # calentamiento
+        start = time.perf_counter()
+        probs[name] = engine.predict_proba(texts)
+        timings[name] = (time.perf_counter() - start) / len(texts)
+    diff = np.abs(probs["reference"] - probs["candidate"])
+    return {
+        "texts": len(texts),
+        "label_agreement": float((probs["reference"].argmax(1) == probs["candidate"].argmax(1)).mean()),
+        "max_prob_diff": float(diff.max()),
+        "mean_prob_diff": float(diff.mean()),
+        "reference_ms_per_text": 1000 * timings["reference"],
+        "candidate_ms_per_text": 1000 * timings["candidate"],
+    }
+
+
+# ------------------------------------------------------------------ CLI
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sentimiento por segmento de transcripciones")
+    parser.add_argument("inputs", nargs="*", help="Archivos de texto (por defecto transcripcion_whisper.txt; '-' = stdin)")
+    parser.add_argument("--backend", choices=BACKENDS, default=BACKEND)
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--out", help="Salida JSONL, un segmento por línea (por defecto solo el resumen)")
+    parser.add_argument("--validate", action="store_true",
+                        help="Compara el backend elegido contra torch sobre los segmentos de entrada")
+    parser.add_argument("--export", action="store_true", help="Exporta (y cuantiza) de nuevo el modelo ONNX")
+    args = parser.parse_args(argv)
+
+    if args.export and args.backend != "torch":
+        print(json.dumps(export_onnx_model(args.model_dir, quantize=args.backend == "onnx-int8"), indent=2))
+    inputs = args.inputs or [os.path.join(BASE_DIR, "transcripcion_whisper.txt")]
+    start = time.perf_counter()
+    engine = get_engine(args.backend, args.model_dir)
+    print(f"Modelo cargado ({engine.backend}) en {time.perf_counter() - start:.1f}s")
+
+    out = open(args.out, "w", encoding="utf-8") if args.out else None
+    try:
+        for path in inputs:
+            if path == "-":
+                text = sys.stdin.read()
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    text = f.read()
+            start = time.perf_counter()
+            result = engine.analyze_text(text, args.batch_size)
+            elapsed = time.perf_counter() - start
+            n = result["summary"]["segments"]
+            rate = 60 * n / elapsed if elapsed > 0 else 0.0
+            print(json.dumps({"input": path, **result["summary"], "seconds": round(elapsed, 3),
+                              "segments_per_minute": round(rate)}, ensure_ascii=False))
+            if out:
+                for r in result["segments"]:
+                    out.write(json.dumps({"input": path, **r}, ensure_ascii=False) + "\n")
+            if args.validate and engine.backend != "torch":
+                segments = [r["text"] for r in result["segments"]]
+                report = compare_engines(get_engine("torch", args.model_dir), engine, segments or None)
+                print(json.dumps(report, indent=2))
+    finally:
+        if out:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
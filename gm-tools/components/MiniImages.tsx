@@ -3,6 +3,8 @@ import React, { useState } from "react";
 
 export type ImageData = {
     src: string;
+    // Miniatura para la grilla; la original se carga solo al ampliar
+    thumb?: string;
     source: string;
     page?: number;
 };
@@ -23,7 +25,8 @@ export default function ImageThumbnails({ images }: { images: ImageData[] }) {
                 {images.map((img, idx) => (
                     <div key={idx} style={{ cursor: "pointer", textAlign: "center" }}>
                         <img
-                            src={`http://localhost:8000${img.src.startsWith('/') ? '' : '/'}${img.src}`}
+                            src={`http://localhost:8000${(img.thumb || img.src).startsWith('/') ? '' : '/'}${img.thumb || img.src}`}
+                            loading="lazy"
                             alt={`Imagen ${idx}`}
                             style={{
                                 width: 160,